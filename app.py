@@ -1,37 +1,73 @@
-from flask import Flask, request, jsonify, render_template, session
+from flask import Flask, Response, request, jsonify, render_template, session
 import os
 import json
 import uuid
 from datetime import datetime
 import asyncio
+import threading
 from werkzeug.utils import secure_filename
-from doc import analyze_file, analyze_data_with_ai
+from doc import analyze_file, analyze_data_with_ai, append_data_to_file, execute_query, query_result_to_dict
 from database import ChatDatabase
+import followup
+import ingest
+import lifecycle
+import metrics
+import rollup
 from dotenv import load_dotenv
 
 load_dotenv()
 
 app = Flask(__name__)
-app.secret_key = 'your-secret-key-change-this'
+# 多进程部署时所有工作进程必须使用相同的密钥，否则会话无法在进程间共享
+app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-this')
 
 # 配置文件上传
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'csv', 'xlsx', 'xls', 'parquet', 'json'}
+# 上传时还可以是打包了多个数据文件的压缩包，追加数据时不支持
+ARCHIVE_EXTENSIONS = ingest.ARCHIVE_SUFFIXES
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
+# 查询画像：查询耗时超过该阈值（毫秒）时保存DuckDB的查询画像，未设置则不开启
+QUERY_PROFILE_THRESHOLD_MS = os.environ.get('QUERY_PROFILE_THRESHOLD_MS')
+if QUERY_PROFILE_THRESHOLD_MS:
+    QUERY_PROFILE_THRESHOLD_MS = float(QUERY_PROFILE_THRESHOLD_MS)
+else:
+    QUERY_PROFILE_THRESHOLD_MS = None
+
+# 预聚合表：根据历史提问为高频的分组聚合查询在后台构建预聚合表，并改写匹配的查询
+ENABLE_ROLLUPS = os.environ.get('ENABLE_ROLLUPS', '').lower() in ('1', 'true', 'yes')
+ROLLUP_MIN_QUERIES = int(os.environ.get('ROLLUP_MIN_QUERIES', 3))
+ROLLUP_MIN_ROWS = int(os.environ.get('ROLLUP_MIN_ROWS', 100000))
+
+# 追问：提示词中加入会话最近的问答（token预算，0 为不加入），简单的追问直接修改上一条SQL
+FOLLOWUP_CONTEXT_TOKENS = int(os.environ.get('FOLLOWUP_CONTEXT_TOKENS') or followup.DEFAULT_CONTEXT_TOKENS)
+FOLLOWUP_FAST_PATH = (os.environ.get('FOLLOWUP_FAST_PATH') or '1').lower() in ('1', 'true', 'yes')
+
+# 数据集生命周期：TTL、磁盘配额和压缩策略通过环境变量配置，均未设置时不清理
+LIFECYCLE_POLICY = lifecycle.policy_from_env()
+LIFECYCLE_ENABLED = any(value is not None for value in LIFECYCLE_POLICY.values())
+LIFECYCLE_INTERVAL_SECONDS = int(os.environ.get('LIFECYCLE_INTERVAL_SECONDS', 600))
+
 # 确保上传文件夹存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-def allowed_file(filename):
+def allowed_file(filename, allow_archive=False):
+    if allow_archive and filename.lower().endswith(ARCHIVE_EXTENSIONS):
+        return True
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 # 初始化数据库
 db = ChatDatabase()
 
+# 定期清理数据集；多个工作进程各自启动，通过锁文件保证同一时刻只有一个在清理
+if LIFECYCLE_ENABLED:
+    lifecycle.start_periodic_sweeps(db, UPLOAD_FOLDER, LIFECYCLE_INTERVAL_SECONDS, **LIFECYCLE_POLICY)
+
 def format_analysis_result(result):
     """将AI分析结果转换为markdown格式"""
     if "error" in result:
@@ -49,8 +85,33 @@ def format_analysis_result(result):
     markdown_content.append("```sql")
     markdown_content.append(result['sql_query'])
     markdown_content.append("```")
+    if result.get('rollup'):
+        markdown_content.append(f"*⚡ 已使用预聚合表 `{result['rollup']['table']}` 加速查询*")
+    if result.get('followup'):
+        markdown_content.append(
+            f"*↪️ 在上一个问题「{result['followup']['based_on']}」的SQL上{'、'.join(result['followup']['changes'])}，未调用LLM*"
+        )
     markdown_content.append("")
 
+    # 近似结果说明
+    approximate = result.get('approximate')
+    if approximate and approximate['applied']:
+        markdown_content.append("### ⚠️ 近似结果")
+        if approximate['method'] == 'hyperloglog':
+            markdown_content.append("- 去重计数使用 HyperLogLog 在全部数据上估算")
+        else:
+            markdown_content.append(
+                f"- 基于约 {approximate['sample_rows']:,} 行样本"
+                f"（抽样比例 {approximate['sampling_fraction']:.2%}）估算"
+            )
+        for column, estimate in approximate['error_estimates'].items():
+            if estimate['max_relative_error'] is not None:
+                markdown_content.append(
+                    f"- `{column}` 的误差不超过 ±{estimate['max_relative_error']:.2%}（95% 置信区间）"
+                )
+        markdown_content.append("- 需要精确结果时可在后台重新精确执行")
+        markdown_content.append("")
+
     # 数据信息
     data_info = result['data_info']
     markdown_content.append("### 📋 数据概览")
@@ -106,12 +167,22 @@ def format_analysis_result(result):
 
     return "\n".join(markdown_content)
 
+@app.after_request
+def count_request(response):
+    """按接口和状态码统计请求次数"""
+    metrics.inc('requests_total', endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
+    with metrics.track_request('upload_file'):
+        return _upload_file()
+
+def _upload_file():
     try:
         if 'file' not in request.files:
             return jsonify({'error': '没有选择文件'}), 400
@@ -121,18 +192,25 @@ def upload_file():
         if file.filename == '':
             return jsonify({'error': '没有选择文件'}), 400
 
-        if not allowed_file(file.filename):
-            return jsonify({'error': '不支持的文件类型，仅支持 CSV, Excel, Parquet, JSON'}), 400
+        if not allowed_file(file.filename, allow_archive=True):
+            return jsonify({'error': '不支持的文件类型，仅支持 CSV, Excel, Parquet, JSON 及其 zip / tar 压缩包'}), 400
+
+        # 多工作表Excel文件和压缩包的导入方式：union 合并为一个表，separate 每个工作表或文件一个表
+        ingest_mode = request.form.get('ingest_mode', 'union')
+        if ingest_mode not in ingest.MODES:
+            return jsonify({'error': f'不支持的导入方式: {ingest_mode}'}), 400
 
         # 保存文件
         filename = secure_filename(file.filename)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_filename = f"{timestamp}_{filename}"
+        # 加入随机后缀，避免同一秒内上传同名文件时共用同一个DuckDB文件
+        unique_filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{filename}"
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
+        with metrics.span('upload_file.save'):
+            file.save(filepath)
 
         # 异步调用文件分析
-        result = asyncio.run(analyze_file(file_path=filepath))
+        result = asyncio.run(analyze_file(file_path=filepath, ingest_mode=ingest_mode))
 
         if 'error' in result:
             # 如果分析出错，删除临时文件
@@ -154,7 +232,12 @@ def upload_file():
             'filepath': filepath,
             'data_info': result['data_info']
         }
-        db.save_file_info(session_id, file_info)
+        with metrics.span('upload_file.save_file_info'):
+            db.save_file_info(session_id, file_info)
+
+        # 新数据集可能使会话或全局占用超出配额，立即在后台检查
+        if LIFECYCLE_ENABLED:
+            lifecycle.sweep_in_background(db, UPLOAD_FOLDER, **LIFECYCLE_POLICY)
 
         # 返回文件信息和数据概要
         return jsonify({
@@ -167,13 +250,77 @@ def upload_file():
         print(f"Error: {str(e)}")
         return jsonify({'error': f'服务器错误: {str(e)}'}), 500
 
+@app.route('/api/files/<file_id>/append', methods=['POST'])
+def append_file(file_id):
+    """将新文件的数据增量追加到已上传的数据集"""
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': '没有选择文件'}), 400
+
+        file = request.files['file']
+
+        if file.filename == '':
+            return jsonify({'error': '没有选择文件'}), 400
+
+        if not allowed_file(file.filename):
+            return jsonify({'error': '不支持的文件类型，仅支持 CSV, Excel, Parquet, JSON'}), 400
+
+        file_detail = db.get_file_detail(file_id)
+        if not file_detail:
+            return jsonify({'error': '文件不存在'}), 404
+        if file_detail['evicted_at']:
+            return jsonify({'error': '数据集已过期被清理，请重新上传文件'}), 410
+
+        # 可选的去重主键，多个列用逗号分隔
+        key_columns = [col.strip() for col in request.form.get('key', '').split(',') if col.strip()]
+
+        # 保存新文件
+        filename = secure_filename(file.filename)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{timestamp}_{uuid.uuid4().hex[:8]}_append_{filename}")
+        file.save(filepath)
+
+        try:
+            result = asyncio.run(append_data_to_file(
+                file_path=filepath,
+                data_info=file_detail['data_info'],
+                key_columns=key_columns
+            ))
+        finally:
+            # 数据已写入DuckDB，新文件不再需要保留
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+        if 'error' in result:
+            return jsonify(result), 400
+
+        db.update_file_info(file_id, result['data_info'])
+        db.touch_file(file_id)
+
+        return jsonify({
+            'success': True,
+            'file_id': file_id,
+            'appended_rows': result['appended_rows'],
+            'replaced_rows': result['replaced_rows'],
+            'row_count': result['data_info']['行数']
+        })
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': f'服务器错误: {str(e)}'}), 500
+
 @app.route('/api/ask_question', methods=['POST'])
 def ask_question():
+    with metrics.track_request('ask_question') as breakdown:
+        return _ask_question(breakdown)
+
+def _ask_question(breakdown):
     try:
         # 获取请求参数
         data = request.get_json()
         file_id = data.get('file_id')
         question = data.get('question', '')
+        approximate = bool(data.get('approximate', False))
 
         if not file_id:
             return jsonify({'error': '请选择要分析的文件'}), 400
@@ -187,44 +334,88 @@ def ask_question():
             return jsonify({'error': '请先上传文件'}), 400
 
         # 获取文件详情
-        file_detail = db.get_file_detail(file_id)
+        with metrics.span('ask_question.get_file_detail'):
+            file_detail = db.get_file_detail(file_id)
         if not file_detail:
             return jsonify({'error': '文件不存在'}), 404
+        if file_detail['evicted_at']:
+            return jsonify({'error': '数据集已过期被清理，请重新上传文件'}), 410
+        db.touch_file(file_id)
 
         # 检查文件是否属于当前会话
         # 注意：这里简化处理，实际应该检查file_detail.session_id == session_id
 
+        # 同一会话中针对该文件最近的问答，用于追问
+        history = None
+        if FOLLOWUP_CONTEXT_TOKENS > 0 or FOLLOWUP_FAST_PATH:
+            with metrics.span('ask_question.get_history'):
+                history = db.get_recent_queries(session_id, file_id, limit=followup.HISTORY_LIMIT)
+
         # 异步调用AI分析
         result = asyncio.run(
             analyze_data_with_ai(
                 file_path=file_detail['filepath'],
                 question=question,
-                data_info=file_detail['data_info']
+                data_info=file_detail['data_info'],
+                profile_threshold_ms=QUERY_PROFILE_THRESHOLD_MS,
+                use_rollups=ENABLE_ROLLUPS,
+                approximate=approximate,
+                history=history,
+                history_tokens=FOLLOWUP_CONTEXT_TOKENS,
+                refine_locally=FOLLOWUP_FAST_PATH
             )
         )
 
         if 'error' in result:
             return jsonify(result), 400
 
+        # 查询画像单独保存，不放入结果中
+        query_profile = result.pop('query_profile', None)
+
         # 将结果转换为markdown格式
-        markdown_result = format_analysis_result(result)
+        with metrics.span('ask_question.format_markdown'):
+            markdown_result = format_analysis_result(result)
 
-        # 生成聊天记录
+        # 生成聊天记录，保存后再补充写入最终的分阶段耗时明细
         chat_record = {
             'id': str(uuid.uuid4()),
             'timestamp': datetime.now().isoformat(),
             'question': question,
             'result': result,
-            'markdown_result': markdown_result
+            'markdown_result': markdown_result,
+            'timings': breakdown,
+            'query_profile': query_profile
         }
 
         # 保存到数据库
-        db.save_chat_record(session_id, file_id, chat_record)
+        with metrics.span('ask_question.save_chat_record'):
+            version = db.save_chat_record(session_id, file_id, chat_record)
+
+        # 根据最新的提问历史在后台刷新预聚合表
+        if ENABLE_ROLLUPS and 'rollup' not in result and '数据表' not in result['data_info']:
+            rollup.refresh_rollups_in_background(
+                result['data_info']['db_path'],
+                result['data_info'],
+                db.get_file_queries(file_id),
+                min_queries=ROLLUP_MIN_QUERIES,
+                min_rows=ROLLUP_MIN_ROWS
+            )
+
+        # 整体耗时截至响应前（包含聊天记录的保存），保存的明细与响应中的一致
+        breakdown['total_ms'] = metrics.request_elapsed_ms()
+        db.update_chat_timings(chat_record['id'], breakdown)
 
         return jsonify({
             'success': True,
             'chat_id': chat_record['id'],
-            'markdown_result': markdown_result
+            # 客户端据此直接更新本地的聊天历史和会话列表，无需重新拉取
+            'session_id': session_id,
+            'version': version,
+            'timestamp': chat_record['timestamp'],
+            'markdown_result': markdown_result,
+            'timings': breakdown,
+            # 为近似结果时可通过 /api/chat/<chat_id>/exact 在后台精确执行
+            'approximate': bool(result.get('approximate', {}).get('applied'))
         })
 
     except Exception as e:
@@ -233,14 +424,105 @@ def ask_question():
         print(f"Error: {str(e)}")
         return jsonify({'error': f'服务器错误: {str(e)}'}), 500
 
+@app.route('/api/chat/<chat_id>/exact', methods=['POST'])
+def rerun_exact(chat_id):
+    """在后台精确执行近似结果对应的SQL，完成后用精确结果替换聊天记录中的近似结果"""
+    record = db.get_chat_record(chat_id)
+    if not record:
+        return jsonify({'error': '聊天记录不存在'}), 404
+
+    result = record['result']
+    approximate = result.get('approximate') or {}
+    if not approximate.get('applied'):
+        return jsonify({'error': '该记录已是精确结果'}), 400
+
+    if approximate.get('exact_status') != 'running':
+        approximate['exact_status'] = 'running'
+        db.update_chat_result(chat_id, result, record['markdown_result'])
+        threading.Thread(
+            target=_run_exact_query,
+            args=(chat_id, result, record['markdown_result']),
+            daemon=True
+        ).start()
+
+    return jsonify({'success': True, 'chat_id': chat_id, 'status': 'running'}), 202
+
+def _run_exact_query(chat_id, result, markdown_result):
+    exact_result = {k: v for k, v in result.items() if k != 'approximate'}
+    try:
+        df, _ = execute_query(result['data_info']['db_path'], result['sql_query'])
+        exact_result['result'] = query_result_to_dict(df)
+        db.update_chat_result(chat_id, exact_result, format_analysis_result(exact_result))
+    except Exception as e:
+        print(f"精确查询失败: {str(e)}")
+        result['approximate'].update(exact_status='failed', exact_error=str(e))
+        db.update_chat_result(chat_id, result, markdown_result)
+
+@app.route('/api/chat/<chat_id>/exact')
+def get_exact_result(chat_id):
+    """查询后台精确执行的状态，完成后返回精确结果"""
+    record = db.get_chat_record(chat_id)
+    if not record:
+        return jsonify({'error': '聊天记录不存在'}), 404
+
+    approximate = record['result'].get('approximate') or {}
+    if approximate.get('applied'):
+        return jsonify({
+            'chat_id': chat_id,
+            'status': approximate.get('exact_status', 'not_started'),
+            'error': approximate.get('exact_error')
+        })
+
+    return jsonify({
+        'chat_id': chat_id,
+        'status': 'done',
+        'markdown_result': record['markdown_result']
+    })
+
+@app.route('/metrics')
+def get_metrics():
+    """以 Prometheus 文本格式输出指标"""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/chat/<chat_id>/profile')
+def get_query_profile(chat_id):
+    """获取单条聊天记录的DuckDB查询画像"""
+    profile = db.get_query_profile(chat_id)
+    if not profile:
+        return jsonify({'error': '聊天记录不存在'}), 404
+    if not profile['query_profile']:
+        return jsonify({'error': '该查询未超过阈值或未开启查询画像'}), 404
+    return jsonify(profile)
+
+@app.route('/api/slow_queries')
+def get_slow_queries():
+    """列出保存了查询画像的慢查询，便于发现生成SQL中的低效模式"""
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({'queries': db.get_slow_queries(limit)})
+
+def _history_delta(session_id):
+    """按请求参数获取会话的增量聊天历史
+
+    查询参数 since 为客户端已同步到的版本号，只返回之后新增或更新的记录；
+    light=1 时不返回结果数据，只返回渲染所需的markdown。
+    """
+    since = request.args.get('since', 0, type=int)
+    light = request.args.get('light', '0') in ('1', 'true')
+    history = db.get_chat_history(session_id, since_version=since, light=light)
+    return {
+        'session_id': session_id,
+        'history': history,
+        'version': max([since] + [record['version'] for record in history])
+    }
+
 @app.route('/api/chat_history')
 def get_chat_history():
+    """获取当前会话的聊天历史，支持 since 和 light 参数增量获取"""
     session_id = session.get('session_id')
     if not session_id:
-        return jsonify({'history': []})
+        return jsonify({'session_id': None, 'history': [], 'version': 0})
 
-    history = db.get_chat_history(session_id)
-    return jsonify({'history': history})
+    return jsonify(_history_delta(session_id))
 
 @app.route('/api/new_session', methods=['POST'])
 def new_session():
@@ -255,6 +537,17 @@ def get_all_sessions():
     sessions = db.get_all_sessions()
     return jsonify({'sessions': sessions})
 
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    """删除会话及其聊天记录、文件记录和磁盘上的数据文件"""
+    if not db.session_exists(session_id):
+        return jsonify({'error': '会话不存在'}), 404
+
+    db.delete_session(session_id)
+    if session.get('session_id') == session_id:
+        session.pop('session_id')
+    return jsonify({'success': True})
+
 @app.route('/api/files')
 def get_files():
     """获取当前会话的所有文件"""
@@ -267,10 +560,10 @@ def get_files():
 
 @app.route('/api/switch_session/<session_id>', methods=['POST'])
 def switch_session(session_id):
-    """切换到指定会话"""
+    """切换到指定会话，同时返回该会话的增量聊天历史（参数同 /api/chat_history）"""
     if db.session_exists(session_id):
         session['session_id'] = session_id
-        return jsonify({'success': True, 'session_id': session_id})
+        return jsonify({'success': True, **_history_delta(session_id)})
     else:
         return jsonify({'error': '会话不存在'}), 404
 
@@ -0,0 +1,403 @@
+"""近似查询
+
+超大数据集上的探索性提问，几百毫秒得到的近似答案往往比几十秒的精确答案更有用。本模块将
+生成的聚合查询改写为在样本上执行，并给出误差估计：
+
+1. 样本来自数据集DuckDB文件中维护的蓄水池样本表（_sample），在后台构建，追加数据后失效；
+   样本尚未构建好时使用 DuckDB 的 TABLESAMPLE 系统抽样（按数据块抽样，数据按某列有序存放时
+   误差估计会偏乐观）
+2. COUNT / SUM 按抽样比例放大，AVG、中位数、分位数、方差等直接在样本上计算，
+   并为 COUNT / SUM / AVG 结果列计算95%置信区间的误差
+3. COUNT(DISTINCT) 无法由样本推算，改为在全表上使用 approx_count_distinct（HyperLogLog）
+
+MIN / MAX 等无法由样本估计的查询，以及非聚合查询，仍按精确方式执行。
+"""
+import math
+import os
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+import metrics
+import sql_ast
+import storage
+
+SAMPLE_TABLE = '_sample'
+META_TABLE = '_sample_meta'
+
+# 样本行数
+SAMPLE_ROWS = 100000
+
+# 数据集行数低于该值时精确查询已经足够快，不做近似
+MIN_ROWS = 1000000
+
+# 抽样使用固定的随机种子，同一份数据上的多次查询使用相同的样本
+SAMPLE_SEED = 42
+
+# 95%置信区间对应的正态分位数
+Z_95 = 1.96
+
+# DuckDB 的 approx_count_distinct 使用64个寄存器的HyperLogLog，相对标准误差约为 1.04/sqrt(64)
+HLL_RELATIVE_ERROR = 1.04 / math.sqrt(64)
+
+# 结果需要按抽样比例放大的聚合函数
+SCALED_AGGREGATES = {'count', 'count_star', 'sum'}
+
+# 直接在样本上计算即可估计总体的聚合函数
+SAMPLE_AGGREGATES = {
+    'avg', 'mean', 'median', 'quantile', 'quantile_cont', 'quantile_disc', 'approx_quantile',
+    'stddev', 'stddev_samp', 'stddev_pop', 'variance', 'var_samp', 'var_pop'
+}
+
+ERROR_COLUMN_PREFIX = '__error_'
+
+_building = set()
+_building_lock = threading.Lock()
+_metadata_cache = {}
+_metadata_cache_lock = threading.Lock()
+
+
+class CannotApproximate(Exception):
+    """查询无法近似执行，异常信息为原因"""
+
+
+def _meta_table_exists(conn):
+    return conn.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?", [META_TABLE]
+    ).fetchone()[0] > 0
+
+
+def _read_metadata(conn):
+    if not _meta_table_exists(conn):
+        return None
+    row = conn.execute(
+        f'SELECT data_version, sample_rows, population_rows FROM {META_TABLE}'
+    ).fetchone()
+    if not row:
+        return None
+    return {'data_version': row[0], 'sample_rows': row[1], 'population_rows': row[2]}
+
+
+def load_sample(db_path, data_version):
+    """读取与当前数据版本一致的样本信息，按数据库文件的修改时间缓存
+
+    Returns:
+        dict: {'data_version', 'sample_rows', 'population_rows'}，没有可用样本时返回None
+    """
+    try:
+        stat = os.stat(db_path)
+    except OSError:
+        return None
+    cache_key = (db_path, stat.st_mtime_ns, stat.st_size)
+
+    with _metadata_cache_lock:
+        cached = _metadata_cache.get(db_path)
+    if cached and cached[0] == cache_key:
+        sample = cached[1]
+    else:
+        with storage.connect_read(db_path) as conn:
+            sample = _read_metadata(conn)
+        with _metadata_cache_lock:
+            _metadata_cache[db_path] = (cache_key, sample)
+
+    if sample and sample['data_version'] == data_version:
+        return dict(sample, method='reservoir_sample')
+    return None
+
+
+def drop_sample(conn):
+    """删除数据集的样本，需在写连接中调用（例如追加数据时）"""
+    conn.execute(f'DROP TABLE IF EXISTS {SAMPLE_TABLE}')
+    if _meta_table_exists(conn):
+        conn.execute(f'DELETE FROM {META_TABLE}')
+
+
+def build_sample(db_path, data_info, sample_rows=SAMPLE_ROWS):
+    """构建数据集的蓄水池样本
+
+    抽样在只读连接中完成，只有写入样本时才短暂持有写锁。
+
+    Args:
+        db_path (str): 数据集的DuckDB数据库文件路径
+        data_info (dict): 数据概要信息
+        sample_rows (int): 样本行数
+
+    Returns:
+        int: 样本的实际行数
+    """
+    with metrics.span('approx.build_sample'):
+        with storage.connect_read(db_path) as conn:
+            population_rows = conn.execute('SELECT COUNT(*) FROM data_table').fetchone()[0]
+            sample_data = conn.execute(
+                f'SELECT * FROM data_table USING SAMPLE reservoir({int(sample_rows)} ROWS) REPEATABLE ({SAMPLE_SEED})'
+            ).fetch_arrow_table()
+
+        with storage.connect_write(db_path) as conn:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {META_TABLE} (
+                    data_version INTEGER, sample_rows BIGINT, population_rows BIGINT, created_at TIMESTAMP
+                )
+            ''')
+            drop_sample(conn)
+            conn.execute(f'CREATE TABLE {SAMPLE_TABLE} AS SELECT * FROM sample_data')
+            conn.execute(f'INSERT INTO {META_TABLE} VALUES (?, ?, ?, ?)', [
+                data_info.get('data_version', 0),
+                sample_data.num_rows,
+                population_rows,
+                datetime.now()
+            ])
+
+    metrics.inc('samples_built_total')
+    return sample_data.num_rows
+
+
+def system_sample(db_path, population_rows, sample_rows=SAMPLE_ROWS):
+    """样本尚未构建好时使用的 TABLESAMPLE 系统抽样
+
+    系统抽样按数据块抽取，实际抽到的行数与目标比例偏差较大，这里用固定种子预先统计
+    实际行数，使结果的放大比例与查询实际使用的样本一致。
+
+    Returns:
+        dict: {'method', 'percentage', 'sample_rows', 'population_rows'}
+    """
+    percentage = min(100.0, sample_rows / population_rows * 100)
+    with storage.connect_read(db_path) as conn:
+        rows = conn.execute(
+            f'SELECT COUNT(*) FROM data_table TABLESAMPLE {percentage!r}% (system, {SAMPLE_SEED})'
+        ).fetchone()[0]
+    return {
+        'method': 'system_sample',
+        'percentage': percentage,
+        'sample_rows': rows,
+        'population_rows': population_rows
+    }
+
+
+def build_sample_in_background(db_path, data_info, **options):
+    """在后台线程中构建样本，同一数据集同时只有一个构建任务"""
+    with _building_lock:
+        if db_path in _building:
+            return
+        _building.add(db_path)
+
+    def run():
+        try:
+            build_sample(db_path, data_info, **options)
+        except Exception as e:
+            print(f"样本构建失败: {str(e)}")
+        finally:
+            with _building_lock:
+                _building.discard(db_path)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _choose_method(aggregates):
+    """根据查询中的聚合函数选择近似方式：sample 或 hyperloglog"""
+    if not aggregates:
+        raise CannotApproximate('查询不包含聚合函数')
+
+    count_distinct = False
+    for aggregate in aggregates:
+        name = aggregate['function_name'].lower()
+        if aggregate.get('filter') or (aggregate.get('order_bys') or {}).get('orders'):
+            raise CannotApproximate(f'聚合函数 {name} 带有 FILTER 或 ORDER BY')
+        if aggregate.get('distinct'):
+            if name != 'count':
+                raise CannotApproximate(f'无法近似计算 {name}(DISTINCT ...)')
+            count_distinct = True
+
+    if count_distinct:
+        return 'hyperloglog'
+
+    for aggregate in aggregates:
+        name = aggregate['function_name'].lower()
+        if name not in SCALED_AGGREGATES | SAMPLE_AGGREGATES:
+            raise CannotApproximate(f'聚合函数 {name} 无法由样本估计')
+    return 'sample'
+
+
+def _replace_aggregates(value, replace):
+    """将语法树中的聚合函数节点替换为 replace 的返回值"""
+    aggregate_names = sql_ast.aggregate_function_names()
+
+    def walk(item):
+        if isinstance(item, list):
+            return [walk(v) for v in item]
+        if not isinstance(item, dict):
+            return item
+        if item.get('class') == 'FUNCTION' and item.get('function_name', '').lower() in aggregate_names:
+            return replace(item)
+        return {k: walk(v) for k, v in item.items()}
+
+    return walk(value)
+
+
+def _aggregate_argument(aggregate):
+    if not aggregate['children']:
+        return None
+    return sql_ast.expression_sql(aggregate['children'][0])
+
+
+def plan_approximate(sql, sample, population_rows):
+    """将生成的SQL改写为近似查询
+
+    Args:
+        sql (str): 生成的SQL
+        sample (dict): load_sample 或 system_sample 返回的样本信息
+        population_rows (int): 数据集总行数
+
+    Returns:
+        dict: 近似查询计划，包含改写后的SQL、近似方式、抽样比例以及误差列的对应关系
+
+    Raises:
+        CannotApproximate: 查询无法近似执行
+    """
+    if population_rows < MIN_ROWS:
+        raise CannotApproximate(f'数据集少于 {MIN_ROWS:,} 行，精确查询已足够快')
+    if not sample or not sample['sample_rows']:
+        raise CannotApproximate('没有可用的样本')
+
+    tree, node = sql_ast.parse_select(sql)
+    if node is None or not sql_ast.is_simple_select(node):
+        raise CannotApproximate('只支持直接查询数据表的简单查询')
+    if any(m['type'] not in ('ORDER_MODIFIER', 'LIMIT_MODIFIER') for m in node.get('modifiers', [])):
+        raise CannotApproximate('查询包含 DISTINCT 等修饰')
+    if sql_ast.contains_class(node, {'WINDOW', 'SUBQUERY'}):
+        raise CannotApproximate('查询包含窗口函数或子查询')
+
+    method = _choose_method(sql_ast.find_aggregates([node['select_list'], node.get('having'),
+                                                     node.get('modifiers')]))
+
+    # 保持结果列名不变
+    output_names = [sql_ast.output_name(item) for item in node['select_list']]
+
+    plan = {
+        'method': method,
+        'population_rows': population_rows,
+        'error_columns': {},
+        'relative_error_columns': []
+    }
+    error_items = []
+
+    if method == 'hyperloglog':
+        def replace(aggregate):
+            if not aggregate.get('distinct'):
+                return aggregate
+            replacement = sql_ast.parse_expression(f'approx_count_distinct({_aggregate_argument(aggregate)})')
+            replacement['alias'] = aggregate.get('alias', '')
+            return replacement
+
+        for i, item in enumerate(node['select_list']):
+            if item.get('class') == 'FUNCTION' and item.get('distinct'):
+                plan['relative_error_columns'].append(output_names[i])
+        plan['sampling_fraction'] = 1.0
+        plan['sample_rows'] = population_rows
+    else:
+        plan['method'] = sample['method']
+        plan['sample_rows'] = sample['sample_rows']
+        fraction = sample['sample_rows'] / max(sample['population_rows'], 1)
+        if sample['method'] == 'system_sample':
+            _, sampled = sql_ast.parse_select(
+                f"SELECT * FROM data_table TABLESAMPLE {sample['percentage']!r}% (system, {SAMPLE_SEED})"
+            )
+            node['from_table']['sample'] = sampled['from_table']['sample']
+        else:
+            node['from_table']['table_name'] = SAMPLE_TABLE
+        plan['sampling_fraction'] = fraction
+
+        def replace(aggregate):
+            name = aggregate['function_name'].lower()
+            argument = _aggregate_argument(aggregate)
+            if name == 'count_star':
+                text = f'CAST(ROUND(COUNT(*) / {fraction!r}) AS BIGINT)'
+            elif name == 'count':
+                text = f'CAST(ROUND(COUNT({argument}) / {fraction!r}) AS BIGINT)'
+            elif name == 'sum':
+                text = f'SUM({argument}) / {fraction!r}'
+            else:
+                return aggregate
+            replacement = sql_ast.parse_expression(text)
+            replacement['alias'] = aggregate.get('alias', '')
+            return replacement
+
+        # 直接输出聚合结果的列附带一个隐藏的标准误差列
+        finite_population = 1 - fraction
+        for i, item in enumerate(node['select_list']):
+            if sql_ast.find_aggregates(item) != [item]:
+                continue
+            name = item['function_name'].lower()
+            argument = _aggregate_argument(item)
+            if name == 'count_star':
+                text = f'SQRT(COUNT(*) * {finite_population!r}) / {fraction!r}'
+            elif name == 'count':
+                text = f'SQRT(COUNT({argument}) * {finite_population!r}) / {fraction!r}'
+            elif name == 'sum':
+                text = f'SQRT(SUM(POWER(CAST({argument} AS DOUBLE), 2)) * {finite_population!r}) / {fraction!r}'
+            elif name in ('avg', 'mean'):
+                text = f'STDDEV_SAMP({argument}) / SQRT(COUNT({argument})) * SQRT({finite_population!r})'
+            else:
+                continue
+            error_column = f'{ERROR_COLUMN_PREFIX}{i}'
+            error_item = sql_ast.parse_expression(text)
+            error_item['alias'] = error_column
+            error_items.append(error_item)
+            plan['error_columns'][error_column] = output_names[i]
+
+    select_list = []
+    for item, name in zip(node['select_list'], output_names):
+        rewritten = _replace_aggregates(item, replace)
+        rewritten['alias'] = name
+        select_list.append(rewritten)
+    node['select_list'] = select_list + error_items
+    node['having'] = _replace_aggregates(node.get('having'), replace)
+    node['modifiers'] = _replace_aggregates(node.get('modifiers') or [], replace)
+
+    plan['sql'] = sql_ast.deparse(tree)
+    return plan
+
+
+def collect_error_estimates(result, plan):
+    """从近似查询结果中取出误差列
+
+    Args:
+        result (DataFrame): 近似查询的结果
+        plan (dict): plan_approximate 返回的查询计划
+
+    Returns:
+        tuple: (去掉误差列后的结果, {结果列名: {'margins': 每行的95%置信区间半宽, 'max_relative_error': 最大相对误差}})
+    """
+    estimates = {}
+    for error_column, column in plan['error_columns'].items():
+        margins = result[error_column].astype(float) * Z_95
+        estimates[column] = _summarize_margins(margins, result[column])
+
+    for column in plan['relative_error_columns']:
+        margins = result[column].astype(float).abs() * (HLL_RELATIVE_ERROR * Z_95)
+        estimates[column] = _summarize_margins(margins, result[column])
+
+    return result.drop(columns=list(plan['error_columns'])), estimates
+
+
+def _summarize_margins(margins, values):
+    values = pd.to_numeric(values, errors='coerce').astype(float).abs()
+    relative = (margins / values).replace([float('inf'), -float('inf')], float('nan')).dropna()
+    return {
+        'margins': [None if pd.isna(m) else round(float(m), 6) for m in margins],
+        'max_relative_error': round(float(relative.max()), 6) if not relative.empty else None
+    }
+
+
+def describe(plan, error_estimates):
+    """近似查询的说明信息，随分析结果返回"""
+    return {
+        'applied': True,
+        'method': plan['method'],
+        'sampling_fraction': plan['sampling_fraction'],
+        'sample_rows': plan['sample_rows'],
+        'population_rows': plan['population_rows'],
+        'confidence': 0.95,
+        'executed_sql': plan['sql'],
+        'error_estimates': error_estimates
+    }
@@ -0,0 +1,440 @@
+"""端到端性能基准测试
+
+生成合成数据集（CSV / Parquet / JSON / Excel，窄表与宽表），对数据导入、
+AI 分析（使用本地桩代替 Gemini）、聊天记录数据库以及 Flask 接口并发访问
+分别计时，输出吞吐量、p50/p99 延迟和峰值内存（RSS）。
+
+用法示例：
+
+    python benchmark.py --sizes 1MB,10MB --formats csv,parquet --schemas narrow,wide
+    python benchmark.py --sizes 100MB --output bench.json --compare baseline.json
+
+每个数据集在独立的子进程中运行，保证峰值内存互不干扰。
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+
+try:
+    import resource
+except ImportError:  # Windows 下没有 resource 模块
+    resource = None
+
+FORMATS = ['csv', 'parquet', 'json', 'xlsx']
+SCHEMAS = ['narrow', 'wide']
+
+# Excel 单个工作表的最大行数（不含表头）
+EXCEL_MAX_ROWS = 1048575
+
+# 本地桩LLM返回的固定SQL，窄表和宽表都包含这些列
+STUB_SQL = """```sql
+SELECT region, SUM(amount) AS total_amount, COUNT(*) AS orders
+FROM data_table
+GROUP BY region
+ORDER BY total_amount DESC
+```"""
+
+REGIONS = ['华东', '华南', '华北', '西南', '西北', '东北']
+PRODUCTS = [f'产品{i:03d}' for i in range(200)]
+
+
+def parse_size(text):
+    """将 1MB、10GB 等大小描述解析为字节数"""
+    text = text.strip().upper()
+    units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+    for unit, factor in units.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def format_size(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024 or unit == 'GB':
+            return f"{num_bytes:.0f}{unit}" if unit == 'B' else f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+
+
+def peak_rss_mb():
+    """返回当前进程的峰值内存（MB）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 下单位为KB，macOS 下单位为字节
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies, units=None, unit_name=None):
+    """根据每次执行的耗时（秒）汇总统计信息"""
+    summary = {
+        'runs': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_mb': peak_rss_mb()
+    }
+    if units is not None:
+        summary['throughput'] = units / percentile(latencies, 50)
+        summary['throughput_unit'] = f'{unit_name}/s'
+    return summary
+
+
+def make_chunk(rows, start, schema, seed):
+    """生成一批合成数据"""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    days = rng.integers(0, 3 * 365, rows)
+    df = pd.DataFrame({
+        'id': np.arange(start, start + rows),
+        'order_date': (pd.Timestamp('2022-01-01') + pd.to_timedelta(days, unit='D')).strftime('%Y-%m-%d'),
+        'region': rng.choice(REGIONS, rows),
+        'product': rng.choice(PRODUCTS, rows),
+        'quantity': rng.integers(1, 20, rows),
+        'amount': rng.gamma(2.0, 150.0, rows).round(2)
+    })
+    if schema == 'wide':
+        for i in range(50):
+            df[f'metric_{i:02d}'] = rng.normal(100, 25, rows).round(3)
+        for i in range(4):
+            df[f'attr_{i:02d}'] = rng.choice([f'值{j}' for j in range(30)], rows)
+    return df
+
+
+def generate_dataset(path, fmt, target_bytes, schema, seed=0):
+    """生成接近目标大小的合成数据文件，返回实际行数"""
+    # 先写一小批数据估算每行字节数
+    probe = make_chunk(2000, 0, schema, seed)
+    root, ext = os.path.splitext(path)
+    probe_path = f"{root}_probe{ext}"
+    write_chunks(probe_path, fmt, [probe])
+    bytes_per_row = os.path.getsize(probe_path) / len(probe)
+    os.remove(probe_path)
+
+    total_rows = max(100, int(target_bytes / bytes_per_row))
+    if fmt == 'xlsx' and total_rows > EXCEL_MAX_ROWS:
+        print(f"  Excel 最多支持 {EXCEL_MAX_ROWS} 行，{format_size(target_bytes)} 数据集已截断")
+        total_rows = EXCEL_MAX_ROWS
+
+    chunk_rows = 200_000
+
+    def chunks():
+        for start in range(0, total_rows, chunk_rows):
+            yield make_chunk(min(chunk_rows, total_rows - start), start, schema, seed + start)
+
+    write_chunks(path, fmt, chunks())
+    return total_rows
+
+
+def write_chunks(path, fmt, chunks):
+    """将数据分批写入文件，避免一次性在内存中构造整个数据集"""
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt == 'csv':
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(f, index=False, header=(i == 0))
+    elif fmt == 'json':
+        # 按行写入JSON（每行一个对象），与 load_data_from_file 的首选解析方式一致
+        with open(path, 'w', encoding='utf-8') as f:
+            for chunk in chunks:
+                chunk.to_json(f, orient='records', lines=True, force_ascii=False)
+    elif fmt == 'parquet':
+        writer = None
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+    elif fmt == 'xlsx':
+        # openpyxl 不支持追加写入，只能一次性写出
+        pd.concat(list(chunks), ignore_index=True).to_excel(path, index=False, engine='openpyxl')
+    else:
+        raise ValueError(f"不支持的格式: {fmt}")
+
+
+def install_stub_llm(latency_ms):
+    """用本地桩替换 Gemini 调用，固定返回 STUB_SQL"""
+    import doc
+
+    def stub_generate_sql(prompt):
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+        return STUB_SQL
+
+    doc.generate_sql = stub_generate_sql
+
+
+def timed(repeat, func):
+    """重复执行 func 并返回每次耗时（秒）和最后一次的返回值"""
+    latencies = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        latencies.append(time.perf_counter() - start)
+    return latencies, result
+
+
+def run_dataset_case(case):
+    """在子进程中执行单个数据集的导入与分析基准"""
+    import doc
+
+    install_stub_llm(case['llm_latency_ms'])
+    workdir = tempfile.mkdtemp(prefix='bench_', dir=case['workdir'])
+    try:
+        path = os.path.join(workdir, f"data.{case['format']}")
+        rows = generate_dataset(path, case['format'], case['target_bytes'], case['schema'])
+        file_bytes = os.path.getsize(path)
+        file_mb = file_bytes / 1024 / 1024
+        repeat = case['repeat']
+        results = {}
+
+        latencies, (df, error) = timed(repeat, lambda: asyncio.run(doc.load_data_from_file(path)))
+        if error:
+            raise RuntimeError(error)
+        del df
+        results['load_data_from_file'] = summarize(latencies, file_mb, 'MB')
+
+        latencies, analyze_result = timed(repeat, lambda: asyncio.run(doc.analyze_file(file_path=path)))
+        if 'error' in analyze_result:
+            raise RuntimeError(analyze_result['error'])
+        results['analyze_file'] = summarize(latencies, rows, 'rows')
+
+        data_info = analyze_result['data_info']
+        latencies, ai_result = timed(repeat, lambda: asyncio.run(
+            doc.analyze_data_with_ai(file_path=path, question='各地区销售额', data_info=data_info)
+        ))
+        if 'error' in ai_result:
+            raise RuntimeError(ai_result['error'])
+        results['analyze_data_with_ai'] = summarize(latencies, rows, 'rows')
+
+        return {
+            'name': f"{case['format']}/{case['schema']}/{format_size(case['target_bytes'])}",
+            'rows': rows,
+            'file_bytes': file_bytes,
+            'stages': results
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_database_case(workdir, operations):
+    """ChatDatabase 各操作的基准"""
+    from database import ChatDatabase
+
+    db = ChatDatabase(db_path=os.path.join(workdir, 'bench_chat.db'))
+    session_id = str(uuid.uuid4())
+    file_id = str(uuid.uuid4())
+    data_info = {'行数': 1000, '列数': 6, '列名': ['id', 'region'], '数据类型': {}, '前5行数据': []}
+    result = {'question': '各地区销售额', 'sql_query': STUB_SQL,
+              'result': {'columns': ['region', 'total'], 'data': [{'region': r, 'total': 1.0} for r in REGIONS], 'row_count': 6}}
+
+    stages = {}
+    stages['create_session'] = summarize(timed(operations, lambda: db.create_session(session_id))[0], 1, 'ops')
+    stages['save_file_info'] = summarize(timed(1, lambda: db.save_file_info(session_id, {
+        'id': file_id, 'filename': 'bench.csv', 'filepath': 'bench.csv', 'data_info': data_info
+    }))[0], 1, 'ops')
+    stages['save_chat_record'] = summarize(timed(operations, lambda: db.save_chat_record(session_id, file_id, {
+        'id': str(uuid.uuid4()), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'question': '各地区销售额', 'result': result, 'markdown_result': '## 结果'
+    }))[0], 1, 'ops')
+    stages['get_chat_history'] = summarize(timed(operations, lambda: db.get_chat_history(session_id))[0], 1, 'ops')
+    stages['get_all_sessions'] = summarize(timed(operations, lambda: db.get_all_sessions())[0], 1, 'ops')
+    stages['get_file_detail'] = summarize(timed(operations, lambda: db.get_file_detail(file_id))[0], 1, 'ops')
+    return {'name': f'ChatDatabase/{operations} ops', 'stages': stages}
+
+
+def run_flask_case(workdir, concurrency, requests_per_worker, llm_latency_ms):
+    """在多个线程中并发访问 Flask 接口"""
+    # app 模块在导入时会在当前目录创建 uploads/ 和 chat_history.db
+    os.chdir(workdir)
+    install_stub_llm(llm_latency_ms)
+    import app as web_app
+
+    data_path = os.path.join(workdir, 'flask_data.csv')
+    generate_dataset(data_path, 'csv', 1024 * 1024, 'narrow')
+    with open(data_path, 'rb') as f:
+        payload = f.read()
+
+    latencies = {'upload': [], 'ask_question': [], 'chat_history': [], 'sessions': []}
+    lock = threading.Lock()
+
+    def record(endpoint, start, response):
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError(f"{endpoint} 返回 {response.status_code}: {response.get_data(as_text=True)[:200]}")
+        with lock:
+            latencies[endpoint].append(elapsed)
+
+    def worker(index):
+        from io import BytesIO
+        client = web_app.app.test_client()
+        start = time.perf_counter()
+        response = client.post('/api/upload', data={'file': (BytesIO(payload), f'bench_{index}.csv')},
+                               content_type='multipart/form-data')
+        record('upload', start, response)
+        file_id = response.get_json()['file_id']
+        for _ in range(requests_per_worker):
+            start = time.perf_counter()
+            record('ask_question', start, client.post('/api/ask_question', json={
+                'file_id': file_id, 'question': '各地区销售额'
+            }))
+            start = time.perf_counter()
+            record('chat_history', start, client.get('/api/chat_history'))
+            start = time.perf_counter()
+            record('sessions', start, client.get('/api/sessions'))
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    wall = time.perf_counter() - wall_start
+
+    stages = {}
+    for endpoint, values in latencies.items():
+        stage = summarize(values)
+        stage['throughput'] = len(values) / wall
+        stage['throughput_unit'] = 'req/s'
+        stages[endpoint] = stage
+    return {'name': f'Flask/{concurrency} 并发', 'stages': stages}
+
+
+def run_in_child(func, *args):
+    """在全新的子进程中执行，使峰值内存只反映该用例"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def print_report(cases):
+    header = f"{'用例':<28}{'阶段':<24}{'次数':>6}{'p50(ms)':>12}{'p99(ms)':>12}{'吞吐量':>22}{'峰值RSS(MB)':>14}"
+    print(header)
+    print('-' * len(header))
+    for case in cases:
+        for stage_name, stage in case['stages'].items():
+            throughput = ''
+            if stage.get('throughput') is not None:
+                throughput = f"{stage['throughput']:,.1f} {stage['throughput_unit']}"
+            rss = '' if stage['peak_rss_mb'] is None else f"{stage['peak_rss_mb']:.1f}"
+            print(f"{case['name']:<28}{stage_name:<24}{stage['runs']:>6}"
+                  f"{stage['p50_ms']:>12.2f}{stage['p99_ms']:>12.2f}{throughput:>22}{rss:>14}")
+
+
+def compare_reports(cases, baseline_path, threshold):
+    """与基线结果比较，返回p50延迟退化超过阈值的阶段"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {case['name']: case for case in json.load(f)['cases']}
+
+    regressions = []
+    for case in cases:
+        base_case = baseline.get(case['name'])
+        if not base_case:
+            continue
+        for stage_name, stage in case['stages'].items():
+            base_stage = base_case['stages'].get(stage_name)
+            if not base_stage or not base_stage['p50_ms']:
+                continue
+            change = (stage['p50_ms'] - base_stage['p50_ms']) / base_stage['p50_ms']
+            if change > threshold:
+                regressions.append((case['name'], stage_name, base_stage['p50_ms'], stage['p50_ms'], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ai-duckdb 端到端性能基准测试')
+    parser.add_argument('--sizes', default='1MB,10MB', help='数据集大小，逗号分隔，例如 1MB,100MB,10GB')
+    parser.add_argument('--formats', default=','.join(FORMATS), help=f"文件格式，可选 {','.join(FORMATS)}")
+    parser.add_argument('--schemas', default=','.join(SCHEMAS), help='表结构，narrow 或 wide')
+    parser.add_argument('--repeat', type=int, default=3, help='每个阶段重复执行的次数')
+    parser.add_argument('--llm-latency-ms', type=float, default=0, help='本地桩LLM模拟的响应延迟')
+    parser.add_argument('--db-operations', type=int, default=200, help='ChatDatabase 每个操作的执行次数，0 表示跳过')
+    parser.add_argument('--concurrency', type=int, default=8, help='Flask 接口并发线程数，0 表示跳过')
+    parser.add_argument('--requests', type=int, default=10, help='每个并发线程发出的提问次数')
+    parser.add_argument('--workdir', default=None, help='生成数据的临时目录，默认使用系统临时目录')
+    parser.add_argument('--output', help='将结果以JSON格式写入文件')
+    parser.add_argument('--compare', help='与之前保存的JSON结果比较')
+    parser.add_argument('--threshold', type=float, default=0.2, help='判定为性能退化的p50增幅，默认 0.2 即 20%%')
+    args = parser.parse_args()
+
+    formats = [f.strip() for f in args.formats.split(',') if f.strip()]
+    schemas = [s.strip() for s in args.schemas.split(',') if s.strip()]
+    sizes = [parse_size(s) for s in args.sizes.split(',') if s.strip()]
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='ai_duckdb_bench_'))
+    os.makedirs(workdir, exist_ok=True)
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    if project_dir not in sys.path:
+        sys.path.insert(0, project_dir)
+
+    cases = []
+    try:
+        for size in sizes:
+            for fmt in formats:
+                for schema in schemas:
+                    print(f"运行 {fmt}/{schema}/{format_size(size)} ...", flush=True)
+                    cases.append(run_in_child(run_dataset_case, {
+                        'format': fmt,
+                        'schema': schema,
+                        'target_bytes': size,
+                        'repeat': args.repeat,
+                        'llm_latency_ms': args.llm_latency_ms,
+                        'workdir': workdir
+                    }))
+
+        if args.db_operations:
+            print("运行 ChatDatabase ...", flush=True)
+            db_dir = tempfile.mkdtemp(prefix='db_', dir=workdir)
+            cases.append(run_in_child(run_database_case, db_dir, args.db_operations))
+
+        if args.concurrency:
+            print("运行 Flask 并发接口 ...", flush=True)
+            flask_dir = tempfile.mkdtemp(prefix='flask_', dir=workdir)
+            cases.append(run_in_child(run_flask_case, flask_dir, args.concurrency,
+                                      args.requests, args.llm_latency_ms))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print_report(cases)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'cases': cases},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+
+    if args.compare:
+        regressions = compare_reports(cases, args.compare, args.threshold)
+        if regressions:
+            print(f"\n发现 {len(regressions)} 项性能退化：")
+            for name, stage, before, after, change in regressions:
+                print(f"  {name} {stage}: {before:.2f}ms -> {after:.2f}ms (+{change:.0%})")
+            sys.exit(1)
+        print("\n未发现性能退化")
+
+
+if __name__ == '__main__':
+    main()
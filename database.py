@@ -4,16 +4,28 @@ from datetime import datetime
 import os
 import duckdb
 
+import lifecycle
+
+# 聊天记录的下一个版本号
+NEXT_VERSION_SQL = '(SELECT COALESCE(MAX(version), 0) + 1 FROM chat_records)'
+
 class ChatDatabase:
     def __init__(self, db_path='chat_history.db'):
         self.db_path = db_path
         self.init_database()
 
+    def _connect(self):
+        """打开数据库连接，多个工作进程同时写入时等待而不是立即报错"""
+        return sqlite3.connect(self.db_path, timeout=30)
+
     def init_database(self):
         """初始化数据库表"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
+        # WAL模式下读写互不阻塞，适合多进程部署
+        cursor.execute('PRAGMA journal_mode=WAL')
+
         # 创建会话表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS sessions (
@@ -32,6 +44,8 @@ class ChatDatabase:
                 filepath TEXT,
                 data_info TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_accessed_at TIMESTAMP,
+                evicted_at TIMESTAMP,
                 FOREIGN KEY (session_id) REFERENCES sessions (id)
             )
         ''')
@@ -46,18 +60,46 @@ class ChatDatabase:
                 question TEXT,
                 result TEXT,
                 markdown_result TEXT,
+                timings TEXT,
+                query_profile TEXT,
+                version INTEGER,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (session_id) REFERENCES sessions (id),
                 FOREIGN KEY (file_id) REFERENCES files (id)
             )
         ''')
 
+        # 为旧版本数据库补充新增的列
+        self._ensure_column(cursor, 'chat_records', 'timings', 'TEXT')
+        self._ensure_column(cursor, 'chat_records', 'query_profile', 'TEXT')
+        self._ensure_column(cursor, 'files', 'last_accessed_at', 'TIMESTAMP')
+        self._ensure_column(cursor, 'files', 'evicted_at', 'TIMESTAMP')
+        self._ensure_column(cursor, 'chat_records', 'version', 'INTEGER')
+
+        # 版本号在所有聊天记录中单调递增，记录新增或结果更新时取新值，客户端据此增量同步
+        cursor.execute('UPDATE chat_records SET version = rowid WHERE version IS NULL')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_records_version ON chat_records (version)')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_records_session_version ON chat_records (session_id, version)
+        ''')
+
         conn.commit()
         conn.close()
 
+    def _ensure_column(self, cursor, table, column, definition):
+        """如果表中缺少指定列则添加该列"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in cursor.fetchall()]:
+            try:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            except sqlite3.OperationalError as e:
+                # 多个工作进程同时启动时，其他进程可能已经添加了该列
+                if 'duplicate column' not in str(e):
+                    raise
+
     def create_session(self, session_id):
         """创建新会话"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -70,7 +112,7 @@ class ChatDatabase:
 
     def save_file_info(self, session_id, file_info):
         """保存文件信息"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         # 确保会话存在
@@ -81,14 +123,15 @@ class ChatDatabase:
         # 保存文件信息
         cursor.execute('''
             INSERT INTO files
-            (id, session_id, filename, filepath, data_info)
-            VALUES (?, ?, ?, ?, ?)
+            (id, session_id, filename, filepath, data_info, last_accessed_at)
+            VALUES (?, ?, ?, ?, ?, ?)
         ''', (
             file_info['id'],
             session_id,
             file_info['filename'],
             file_info['filepath'],
-            json.dumps(file_info['data_info'], ensure_ascii=False)
+            json.dumps(file_info['data_info'], ensure_ascii=False),
+            datetime.now()
         ))
 
         # 更新会话的最后更新时间
@@ -101,7 +144,7 @@ class ChatDatabase:
 
     def get_files(self, session_id):
         """获取指定会话的所有文件"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -125,11 +168,11 @@ class ChatDatabase:
 
     def get_file_detail(self, file_id):
         """获取文件详情"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         cursor.execute('''
-            SELECT id, filename, filepath, data_info
+            SELECT id, filename, filepath, data_info, evicted_at
             FROM files
             WHERE id = ?
         ''', (file_id,))
@@ -142,15 +185,109 @@ class ChatDatabase:
             'id': row[0],
             'filename': row[1],
             'filepath': row[2],
-            'data_info': json.loads(row[3]) if row[3] else {}
+            'data_info': json.loads(row[3]) if row[3] else {},
+            'evicted_at': row[4]
         }
 
         conn.close()
         return file_detail
 
+    def update_file_info(self, file_id, data_info, touch_session=True):
+        """更新文件的数据概要信息
+
+        Args:
+            touch_session (bool): 是否同时更新所属会话的最后更新时间，后台维护任务不应改变会话顺序
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            UPDATE files SET data_info = ? WHERE id = ?
+        ''', (json.dumps(data_info, ensure_ascii=False), file_id))
+
+        # 更新所属会话的最后更新时间
+        if touch_session:
+            cursor.execute('''
+                UPDATE sessions SET updated_at = ?
+                WHERE id = (SELECT session_id FROM files WHERE id = ?)
+            ''', (datetime.now(), file_id))
+
+        conn.commit()
+        conn.close()
+
+    def touch_file(self, file_id):
+        """记录文件最近一次被查询的时间，用于按最近最少使用淘汰数据集"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            UPDATE files SET last_accessed_at = ? WHERE id = ?
+        ''', (datetime.now(), file_id))
+
+        conn.commit()
+        conn.close()
+
+    def get_all_file_details(self):
+        """获取所有未被清理的文件详情，供生命周期管理使用
+
+        session_exists 为 False 表示所属会话已被删除
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT f.id, f.session_id, f.filename, f.filepath, f.data_info,
+                   f.created_at, f.last_accessed_at, s.id IS NOT NULL
+            FROM files f
+            LEFT JOIN sessions s ON f.session_id = s.id
+            WHERE f.evicted_at IS NULL
+        ''')
+
+        files = []
+        for row in cursor.fetchall():
+            files.append({
+                'id': row[0],
+                'session_id': row[1],
+                'filename': row[2],
+                'filepath': row[3],
+                'data_info': json.loads(row[4]) if row[4] else {},
+                'created_at': row[5],
+                'last_accessed_at': row[6],
+                'session_exists': bool(row[7])
+            })
+
+        conn.close()
+        return files
+
+    def mark_file_evicted(self, file_id):
+        """标记文件的数据已被清理，保留记录以便聊天历史仍能显示文件名"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            UPDATE files SET evicted_at = ? WHERE id = ?
+        ''', (datetime.now(), file_id))
+
+        conn.commit()
+        conn.close()
+
+    def delete_file_records(self, file_ids):
+        """删除文件记录"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.executemany('DELETE FROM files WHERE id = ?', [(file_id,) for file_id in file_ids])
+
+        conn.commit()
+        conn.close()
+
     def save_chat_record(self, session_id, file_id, chat_record):
-        """保存聊天记录"""
-        conn = sqlite3.connect(self.db_path)
+        """保存聊天记录
+
+        Returns:
+            int: 该记录的版本号
+        """
+        conn = self._connect()
         cursor = conn.cursor()
 
         # 确保会话存在
@@ -158,11 +295,11 @@ class ChatDatabase:
         if not cursor.fetchone():
             self.create_session(session_id)
 
-        # 保存聊天记录
-        cursor.execute('''
+        # 保存聊天记录，版本号在同一条语句中取值，多个进程同时写入时也不会重复
+        cursor.execute(f'''
             INSERT INTO chat_records
-            (id, session_id, file_id, timestamp, question, result, markdown_result)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            (id, session_id, file_id, timestamp, question, result, markdown_result, timings, query_profile, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {NEXT_VERSION_SQL})
         ''', (
             chat_record['id'],
             session_id,
@@ -170,8 +307,12 @@ class ChatDatabase:
             chat_record['timestamp'],
             chat_record['question'],
             json.dumps(chat_record['result'], ensure_ascii=False),
-            chat_record['markdown_result']
+            chat_record['markdown_result'],
+            json.dumps(chat_record['timings'], ensure_ascii=False) if chat_record.get('timings') else None,
+            json.dumps(chat_record['query_profile'], ensure_ascii=False) if chat_record.get('query_profile') else None
         ))
+        cursor.execute('SELECT version FROM chat_records WHERE id = ?', (chat_record['id'],))
+        version = cursor.fetchone()[0]
 
         # 更新会话的最后更新时间
         cursor.execute('''
@@ -180,19 +321,33 @@ class ChatDatabase:
 
         conn.commit()
         conn.close()
+        return version
+
+    def get_chat_history(self, session_id, since_version=0, light=False):
+        """获取指定会话的聊天历史
+
+        Args:
+            session_id: 会话ID
+            since_version: 只返回版本号大于该值的记录（新增或结果被更新的记录）
+            light: 为True时不返回结果数据和耗时明细，只返回渲染所需的markdown
 
-    def get_chat_history(self, session_id):
-        """获取指定会话的聊天历史"""
-        conn = sqlite3.connect(self.db_path)
+        Returns:
+            list: 按时间排序的聊天记录
+        """
+        conn = self._connect()
         cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT cr.id, cr.timestamp, cr.question, f.filename, cr.result, cr.markdown_result
+        if light:
+            columns = "COALESCE(cr.markdown_result, ''), json_extract(cr.result, '$.approximate.applied')"
+        else:
+            columns = 'cr.markdown_result, cr.result, cr.timings'
+        cursor.execute(f'''
+            SELECT cr.id, cr.timestamp, cr.question, f.filename, cr.version, {columns}
             FROM chat_records cr
             LEFT JOIN files f ON cr.file_id = f.id
-            WHERE cr.session_id = ?
+            WHERE cr.session_id = ? AND cr.version > ?
             ORDER BY cr.timestamp ASC
-        ''', (session_id,))
+        ''', (session_id, since_version))
 
         records = []
         for row in cursor.fetchall():
@@ -201,17 +356,175 @@ class ChatDatabase:
                 'timestamp': row[1],
                 'question': row[2],
                 'filename': row[3],
-                'result': json.loads(row[4]) if row[4] else {},
+                'version': row[4],
                 'markdown_result': row[5]
             }
+            if light:
+                record['approximate'] = bool(row[6])
+            else:
+                record['result'] = json.loads(row[6]) if row[6] else {}
+                record['timings'] = json.loads(row[7]) if row[7] else None
             records.append(record)
 
         conn.close()
         return records
 
+    def get_chat_record(self, chat_id):
+        """获取单条聊天记录"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT id, session_id, file_id, question, result, markdown_result
+            FROM chat_records
+            WHERE id = ?
+        ''', (chat_id,))
+
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return None
+
+        return {
+            'id': row[0],
+            'session_id': row[1],
+            'file_id': row[2],
+            'question': row[3],
+            'result': json.loads(row[4]) if row[4] else {},
+            'markdown_result': row[5]
+        }
+
+    def update_chat_result(self, chat_id, result, markdown_result):
+        """更新聊天记录的分析结果（例如近似结果被精确结果替换）"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute(f'''
+            UPDATE chat_records SET result = ?, markdown_result = ?, version = {NEXT_VERSION_SQL} WHERE id = ?
+        ''', (json.dumps(result, ensure_ascii=False), markdown_result, chat_id))
+
+        conn.commit()
+        conn.close()
+
+    def update_chat_timings(self, chat_id, timings):
+        """保存聊天记录最终的分阶段耗时明细（包含聊天记录的写入和端到端耗时）
+
+        耗时明细不影响页面显示，不更新版本号
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            UPDATE chat_records SET timings = ? WHERE id = ?
+        ''', (json.dumps(timings, ensure_ascii=False), chat_id))
+
+        conn.commit()
+        conn.close()
+
+    def get_file_queries(self, file_id, limit=200):
+        """获取针对指定文件最近生成的SQL"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT json_extract(result, '$.sql_query')
+            FROM chat_records
+            WHERE file_id = ?
+            ORDER BY timestamp DESC
+            LIMIT ?
+        ''', (file_id, limit))
+
+        queries = [row[0] for row in cursor.fetchall() if row[0]]
+
+        conn.close()
+        return queries
+
+    def get_recent_queries(self, session_id, file_id, limit=5):
+        """获取会话中针对指定文件最近的问题和生成的SQL，用作追问的上下文
+
+        Returns:
+            list: [{'question', 'sql_query'}]，按时间从早到晚排列
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT question, json_extract(result, '$.sql_query')
+            FROM chat_records
+            WHERE session_id = ? AND file_id = ? AND json_extract(result, '$.sql_query') IS NOT NULL
+            ORDER BY timestamp DESC
+            LIMIT ?
+        ''', (session_id, file_id, limit))
+
+        queries = [{'question': row[0], 'sql_query': row[1]} for row in cursor.fetchall()]
+
+        conn.close()
+        return list(reversed(queries))
+
+    def get_query_profile(self, chat_id):
+        """获取聊天记录的查询画像"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT id, question, result, query_profile
+            FROM chat_records
+            WHERE id = ?
+        ''', (chat_id,))
+
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return None
+
+        result = json.loads(row[2]) if row[2] else {}
+        return {
+            'chat_id': row[0],
+            'question': row[1],
+            'sql_query': result.get('sql_query'),
+            'query_profile': json.loads(row[3]) if row[3] else None
+        }
+
+    def get_slow_queries(self, limit=50):
+        """获取保存了查询画像的慢查询，按查询耗时降序排列"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT id, file_id, timestamp, question, result, query_profile
+            FROM chat_records
+            WHERE query_profile IS NOT NULL
+            ORDER BY CAST(json_extract(query_profile, '$.elapsed_ms') AS REAL) DESC
+            LIMIT ?
+        ''', (limit,))
+
+        queries = []
+        for row in cursor.fetchall():
+            result = json.loads(row[4]) if row[4] else {}
+            query_profile = json.loads(row[5])
+            summary = query_profile['summary']
+            queries.append({
+                'chat_id': row[0],
+                'file_id': row[1],
+                'timestamp': row[2],
+                'question': row[3],
+                'sql_query': result.get('sql_query'),
+                'elapsed_ms': query_profile['elapsed_ms'],
+                'rows_scanned': summary.get('rows_scanned'),
+                'spilled_bytes': summary.get('spilled_bytes'),
+                # 只返回最耗时的几个算子，完整画像通过单条接口获取
+                'top_operators': [
+                    {k: op[k] for k in ('operator', 'timing_ms', 'cardinality')}
+                    for op in summary['operators'][:3]
+                ]
+            })
+
+        conn.close()
+        return queries
+
     def get_all_sessions(self):
         """获取所有会话的基本信息"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -247,19 +560,33 @@ class ChatDatabase:
         return sessions
 
     def delete_session(self, session_id):
-        """删除会话及其所有聊天记录"""
-        conn = sqlite3.connect(self.db_path)
+        """删除会话及其所有聊天记录、文件记录和磁盘上的数据文件"""
+        conn = self._connect()
         cursor = conn.cursor()
 
+        cursor.execute('''
+            SELECT id, filepath, data_info FROM files WHERE session_id = ? AND evicted_at IS NULL
+        ''', (session_id,))
+        files = [{
+            'id': row[0],
+            'filepath': row[1],
+            'data_info': json.loads(row[2]) if row[2] else {}
+        } for row in cursor.fetchall()]
+
         cursor.execute('DELETE FROM chat_records WHERE session_id = ?', (session_id,))
+        cursor.execute('DELETE FROM files WHERE session_id = ?', (session_id,))
         cursor.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
 
         conn.commit()
         conn.close()
 
+        # 记录删除后再清理磁盘文件，避免文件已删除而记录仍可被查询
+        for file_detail in files:
+            lifecycle.remove_dataset_files(file_detail)
+
     def session_exists(self, session_id):
         """检查会话是否存在"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         cursor.execute('SELECT id FROM sessions WHERE id = ?', (session_id,))
@@ -1,18 +1,154 @@
 import duckdb
 import pandas as pd
-import pyarrow.parquet as pq
-from io import BytesIO
-from google import genai
 import duckdb
 import hashlib
+import json
+import tempfile
+import time
 from dotenv import load_dotenv
 import os
+import approx
+import followup
+import ingest
+import lifecycle
+import metrics
+import rollup
+import storage
 
 load_dotenv(override=True)
 
 API_KEY=os.environ.get("GEMINI_API_KEY")
 
 
+def generate_sql(prompt: str) -> str:
+    """调用 Gemini API 根据提示词生成SQL
+
+    Args:
+        prompt (str): 完整的提示词
+
+    Returns:
+        str: 模型返回的原始文本
+    """
+    # genai SDK 导入较慢，只在真正调用时导入
+    from google import genai
+
+    # 初始化 Gemini
+    client = genai.Client(api_key=API_KEY)
+
+    response = client.models.generate_content(
+        model="gemini-2.5-flash",
+        contents=prompt
+    )
+
+    # 记录token消耗
+    metrics.inc('llm_requests_total')
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        metrics.inc('llm_tokens_total', usage.prompt_token_count or 0, kind='prompt')
+        metrics.inc('llm_tokens_total', usage.candidates_token_count or 0, kind='completion')
+
+    return response.text
+
+
+def summarize_query_profile(profile: dict) -> dict:
+    """从DuckDB的JSON查询画像中提取关键信息
+
+    Args:
+        profile (dict): DuckDB 输出的 JSON 查询画像
+
+    Returns:
+        dict: 包含总耗时、扫描行数、溢出到磁盘的大小以及按耗时排序的算子列表
+    """
+    operators = []
+
+    def walk(node, depth):
+        # 不同版本的DuckDB字段名略有差异
+        name = node.get('operator_name') or node.get('operator_type') or node.get('name')
+        if name:
+            operators.append({
+                'operator': name,
+                'depth': depth,
+                'timing_ms': round((node.get('operator_timing', node.get('timing')) or 0) * 1000, 3),
+                'cardinality': node.get('operator_cardinality', node.get('cardinality')),
+                'rows_scanned': node.get('operator_rows_scanned'),
+                'extra_info': node.get('extra_info')
+            })
+        for child in node.get('children', []):
+            walk(child, depth + 1)
+
+    for child in profile.get('children', []):
+        walk(child, 0)
+
+    return {
+        'latency_ms': round((profile.get('latency') or 0) * 1000, 3),
+        'rows_scanned': profile.get('cumulative_rows_scanned'),
+        'rows_returned': profile.get('rows_returned'),
+        'peak_buffer_memory': profile.get('system_peak_buffer_memory'),
+        'spilled_bytes': profile.get('system_peak_temp_dir_size'),
+        'operators': sorted(operators, key=lambda op: op['timing_ms'], reverse=True)
+    }
+
+
+def execute_query(db_path: str, sql_query: str, profile_threshold_ms: float = None):
+    """在数据集的DuckDB数据库上执行查询
+
+    Args:
+        db_path (str): DuckDB数据库文件路径
+        sql_query (str): 要执行的SQL
+        profile_threshold_ms (float): 可选，开启查询画像；查询耗时超过该阈值（毫秒）时返回画像
+
+    Returns:
+        tuple: (DataFrame, dict) 查询结果和查询画像（未开启或未超过阈值时为None）
+    """
+    profile_path = None
+    try:
+        with storage.connect_read(db_path, stage='analyze_data_with_ai.duckdb_connect') as conn:
+            if profile_threshold_ms is not None:
+                fd, profile_path = tempfile.mkstemp(suffix='.json', prefix='duckdb_profile_')
+                os.close(fd)
+                conn.execute("PRAGMA enable_profiling='json'")
+                escaped_path = profile_path.replace("'", "''")
+                conn.execute(f"PRAGMA profiling_output='{escaped_path}'")
+
+            start = time.perf_counter()
+            with metrics.span('analyze_data_with_ai.execute'):
+                result = conn.execute(sql_query).fetchdf()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+    except Exception:
+        if profile_path and os.path.exists(profile_path):
+            os.remove(profile_path)
+        raise
+
+    query_profile = None
+    if profile_path:
+        try:
+            if elapsed_ms >= profile_threshold_ms:
+                with open(profile_path, 'r', encoding='utf-8') as f:
+                    profile = json.load(f)
+                query_profile = {
+                    'elapsed_ms': round(elapsed_ms, 3),
+                    'threshold_ms': profile_threshold_ms,
+                    'summary': summarize_query_profile(profile),
+                    'profile': profile
+                }
+                metrics.inc('slow_queries_profiled_total')
+        except (OSError, ValueError) as e:
+            print(f"读取查询画像失败: {str(e)}")
+        finally:
+            os.remove(profile_path)
+
+    return result, query_profile
+
+
+def query_result_to_dict(result):
+    """将查询结果DataFrame转换为返回给前端的字典"""
+    return {
+        "columns": list(result.columns),
+        "data": result.to_dict('records'),
+        "row_count": len(result)
+    }
+
+
 async def load_data_from_file(file_path: str):
     """根据文件类型加载数据到pandas DataFrame
     
@@ -28,53 +164,13 @@ async def load_data_from_file(file_path: str):
         
     # 检查文件类型是否支持数据分析
     file_suffix = os.path.splitext(file_path)[1].lower()
-    if file_suffix not in ['.parquet', '.csv', '.xlsx', '.xls', '.json']:
+    if file_suffix not in ingest.DATA_SUFFIXES:
         return None, "文件类型不支持数据分析，仅支持 parquet、csv、xlsx、xls、json 文件"
 
     try:
-        # 读取文件
-        with open(file_path, 'rb') as f:
-            file_bytes = f.read()
-        
-        # 根据文件类型加载数据到 pandas DataFrame
-        df = None
-        if file_suffix == '.parquet':
-            buffer = BytesIO(file_bytes)
-            table = pq.read_table(buffer)
-            df = table.to_pandas()
-        elif file_suffix == '.csv':
-            df = pd.read_csv(BytesIO(file_bytes))
-        elif file_suffix in ['.xlsx', '.xls']:
-            engine = "openpyxl" if file_suffix == '.xlsx' else "xlrd"
-            df = pd.read_excel(BytesIO(file_bytes), engine=engine)
-        elif file_suffix == '.json':
-            # 尝试不同的JSON读取方式
-            try:
-                # 先尝试按行读取（每行一个JSON对象）
-                df = pd.read_json(BytesIO(file_bytes), lines=True)
-            except:
-                try:
-                    # 再尝试作为JSON数组读取
-                    df = pd.read_json(BytesIO(file_bytes))
-                except:
-                    # 最后尝试手动解析JSON
-                    import json
-                    text_content = file_bytes.decode('utf-8')
-                    json_data = json.loads(text_content)
-
-                    if isinstance(json_data, list):
-                        df = pd.DataFrame(json_data)
-                    elif isinstance(json_data, dict):
-                        # 如果是字典，尝试将其转换为DataFrame
-                        if all(isinstance(v, list) for v in json_data.values()):
-                            # 如果所有值都是列表，作为列数据处理
-                            df = pd.DataFrame(json_data)
-                        else:
-                            # 否则作为单行数据处理
-                            df = pd.DataFrame([json_data])
-                    else:
-                        raise ValueError("不支持的JSON格式")
-        
+        # 直接按路径读取，不再先把整个文件读入内存
+        df = ingest.read_dataframe(file_path)
+
         if df is None or df.empty:
             return None, "无法读取文件数据或文件为空"
             
@@ -83,40 +179,56 @@ async def load_data_from_file(file_path: str):
         return None, f"文件加载失败: {str(e)}"
 
 
-async def analyze_file(*, file_path: str):
+@metrics.timed('analyze_file')
+async def analyze_file(*, file_path: str, db_path: str = None, ingest_mode: str = 'union'):
     """分析文件并返回数据概要信息，同时将数据保存到DuckDB磁盘数据库
 
     Args:
         file_path (str): 文件路径
+        db_path (str): 可选，DuckDB数据库文件路径，默认保存在数据文件所在目录
+        ingest_mode (str): 可选，多工作表Excel文件和压缩包的导入方式，'union' 合并为
+            data_table 并增加 _source 列，'separate' 每个工作表或文件导入为单独的表
 
     Returns:
         dict: 包含数据概要信息的字典
     """
     try:
+        # 生成唯一的数据库文件路径
+        if db_path is None:
+            db_filename = f"data_{os.path.splitext(os.path.basename(file_path))[0]}.duckdb"
+            db_path = os.path.join(os.path.dirname(file_path), db_filename)
+
+        # 多工作表Excel文件和压缩包在进程池中并行导入
+        if os.path.exists(file_path) and ingest.is_multi_source(file_path):
+            data_info = ingest.ingest_sources(file_path, db_path, mode=ingest_mode)
+            data_info["db_path"] = db_path
+            return {
+                "success": True,
+                "data_info": data_info
+            }
+
         # 加载数据
-        df, error = await load_data_from_file(file_path)
+        with metrics.span('analyze_file.load'):
+            df, error = await load_data_from_file(file_path)
         if error:
             return {
                 "error": error
             }
             
         # 生成数据概要信息
-        data_info = {
-            "行数": len(df),
-            "列数": len(df.columns),
-            "列名": list(df.columns),
-            "数据类型": {col: str(dtype) for col, dtype in df.dtypes.items()},
-            "前5行数据": df.head().to_dict('records')
-        }
-        
-        # 生成唯一的数据库文件路径
-        db_filename = f"data_{os.path.splitext(os.path.basename(file_path))[0]}.duckdb"
-        db_path = os.path.join(os.path.dirname(file_path), db_filename)
+        with metrics.span('analyze_file.profile'):
+            data_info = {
+                "行数": len(df),
+                "列数": len(df.columns),
+                "列名": list(df.columns),
+                "数据类型": {col: str(dtype) for col, dtype in df.dtypes.items()},
+                "前5行数据": df.head().to_dict('records')
+            }
         
         # 将数据保存到DuckDB磁盘数据库
-        conn = duckdb.connect(db_path)
-        conn.execute("CREATE OR REPLACE TABLE data_table AS SELECT * FROM df")
-        conn.close()
+        with storage.connect_write(db_path, stage='analyze_file.duckdb_connect') as conn:
+            with metrics.span('analyze_file.duckdb_write'):
+                conn.execute("CREATE OR REPLACE TABLE data_table AS SELECT * FROM df")
         
         # 将数据库路径添加到返回结果中
         data_info["db_path"] = db_path
@@ -131,24 +243,132 @@ async def analyze_file(*, file_path: str):
             "error": f"文件分析出错: {str(e)}"
         }
 
-async def analyze_data_with_ai(*, file_path: str, question: str, data_info: dict = None):
+async def append_data_to_file(*, file_path: str, data_info: dict, key_columns: list = None):
+    """将新文件的数据增量追加到已有数据集的DuckDB表中
+
+    只加载新文件中的数据并写入已有的 data_table，不会重新导入原始文件。
+    如果提供了 key_columns，则按主键去重：新文件中的行会替换表中主键相同的旧行。
+
+    Args:
+        file_path (str): 新数据文件路径
+        data_info (dict): 已有数据集的数据概要信息（包含db_path）
+        key_columns (list): 可选，用于去重的主键列
+
+    Returns:
+        dict: 包含更新后数据概要信息的字典
+    """
+    db_path = data_info.get("db_path")
+    if not db_path or not os.path.exists(db_path):
+        return {
+            "error": "数据库文件不存在，无法追加数据"
+        }
+    if "数据表" in data_info:
+        return {
+            "error": "按工作表或文件分表导入的数据集不支持追加数据"
+        }
+
+    df, error = await load_data_from_file(file_path)
+    if error:
+        return {
+            "error": error
+        }
+
+    # 新文件的列必须是已有数据集列的子集，缺失的列以NULL填充
+    extra_columns = [col for col in df.columns if col not in data_info['列名']]
+    if extra_columns:
+        return {
+            "error": f"新文件包含原数据集中不存在的列: {', '.join(map(str, extra_columns))}"
+        }
+
+    key_columns = [col for col in (key_columns or []) if col]
+    missing_keys = [col for col in key_columns if col not in df.columns]
+    if missing_keys:
+        return {
+            "error": f"新文件缺少主键列: {', '.join(missing_keys)}"
+        }
+
+    try:
+        with storage.connect_write(db_path) as conn:
+            conn.begin()
+            try:
+                # 已压缩为Parquet的数据集先还原为普通表才能写入
+                compacted_path = lifecycle.restore_compacted(conn, data_info)
+                replaced_rows = 0
+                if key_columns:
+                    # 新文件内部先按主键去重，保留最后出现的行
+                    df = df.drop_duplicates(subset=key_columns, keep='last')
+                    condition = " AND ".join(
+                        f'data_table."{col}" = df."{col}"' for col in key_columns
+                    )
+                    replaced_rows = conn.execute(
+                        f"DELETE FROM data_table USING df WHERE {condition}"
+                    ).fetchone()[0]
+                appended_rows = conn.execute(
+                    "INSERT INTO data_table BY NAME SELECT * FROM df"
+                ).fetchone()[0]
+                # 预聚合表和样本依赖原有数据，随数据版本一起失效
+                rollup.drop_rollups(conn)
+                approx.drop_sample(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    except Exception as e:
+        return {
+            "error": f"数据追加失败: {str(e)}"
+        }
+
+    # 增量更新数据概要，版本号用于让依赖该数据集的缓存失效
+    data_info = dict(data_info)
+    if compacted_path:
+        data_info.pop("compacted_path")
+        os.remove(compacted_path)
+    data_info["行数"] = data_info["行数"] - replaced_rows + appended_rows
+    data_info["data_version"] = data_info.get("data_version", 0) + 1
+
+    return {
+        "success": True,
+        "data_info": data_info,
+        "appended_rows": appended_rows,
+        "replaced_rows": replaced_rows
+    }
+
+@metrics.timed('analyze_data_with_ai')
+async def analyze_data_with_ai(*, file_path: str, question: str, data_info: dict = None,
+                               profile_threshold_ms: float = None, use_rollups: bool = False,
+                               approximate: bool = False, history: list = None,
+                               history_tokens: int = followup.DEFAULT_CONTEXT_TOKENS,
+                               refine_locally: bool = False):
     """使用AI分析文件数据
 
     Args:
         file_path (str): 文件路径
         question (str): 用户问题
         data_info (dict): 可选，数据概要信息（包含db_path）
+        profile_threshold_ms (float): 可选，开启查询画像，查询耗时超过该阈值（毫秒）时
+            在结果中附带 DuckDB 的 JSON 查询画像（query_profile）
+        use_rollups (bool): 可选，能由预聚合表回答时改写SQL读取预聚合表
+        approximate (bool): 可选，在样本上执行聚合查询并返回误差估计（approximate），
+            无法近似的查询仍精确执行
+        history (list): 可选，会话中最近的问答 [{'question', 'sql_query'}]（从早到晚），
+            在 history_tokens 的token预算内加入提示词作为追问的上下文
+        history_tokens (int): 可选，对话上下文的token预算
+        refine_locally (bool): 可选，追问只包含筛选、排序、条数限制时直接修改上一条SQL，
+            不调用LLM（结果中附带 followup）
 
     Returns:
         dict: 包含分析结果的字典
     """
     # 如果没有提供data_info，则先分析文件获取数据概要和数据库路径
     if data_info is None:
+        metrics.inc('cache_requests_total', cache='data_info', result='miss')
         analyze_result = await analyze_file(file_path=file_path)
         if "error" in analyze_result:
             return analyze_result
         data_info = analyze_result["data_info"]
-    
+    else:
+        metrics.inc('cache_requests_total', cache='data_info', result='hit')
+
     # 检查data_info中是否包含数据库路径
     if "db_path" not in data_info:
         # 如果没有数据库路径，生成唯一的数据库文件路径
@@ -157,52 +377,181 @@ async def analyze_data_with_ai(*, file_path: str, question: str, data_info: dict
         data_info["db_path"] = db_path
         
         # 加载数据并保存到数据库
-        df, error = await load_data_from_file(file_path)
-        if error:
+        with metrics.span('analyze_data_with_ai.ingest'):
+            df, error = await load_data_from_file(file_path)
+            if error:
+                return {
+                    "error": error
+                }
+                
+            with storage.connect_write(db_path) as conn:
+                conn.execute("CREATE OR REPLACE TABLE data_table AS SELECT * FROM df")
+
+    # 简单的追问（筛选、排序、条数限制）直接修改上一条SQL，不调用LLM
+    sql_query = None
+    followup_info = None
+    if refine_locally and history:
+        previous = history[-1]
+        with metrics.span('analyze_data_with_ai.followup_refine'):
+            sql_query, changes = followup.refine_previous_sql(
+                question, previous['sql_query'], data_info, data_info.get('db_path')
+            )
+        metrics.inc('followup_requests_total', path='local' if sql_query else 'llm')
+        if sql_query:
+            followup_info = {
+                "based_on": previous['question'],
+                "previous_sql": previous['sql_query'],
+                "changes": changes
+            }
+
+    if sql_query is None:
+        history_text = followup.history_context(history, history_tokens) if history else ''
+        generated = _generate_sql_with_ai(file_path, question, data_info, history_text)
+        if "error" in generated:
+            return generated
+        sql_query = generated["sql_query"]
+
+    # 使用DuckDB执行SQL查询，连接到磁盘数据库
+    try:
+        # 检查数据库路径是否存在
+        db_path = data_info.get("db_path")
+        if not db_path:
             return {
-                "error": error
+                "error": "数据库路径不存在"
+            }
+        
+        # 检查数据库文件是否存在
+        if not os.path.exists(db_path):
+            return {
+                "error": f"数据库文件不存在: {db_path}"
             }
             
-        conn = duckdb.connect(db_path)
-        conn.execute("CREATE OR REPLACE TABLE data_table AS SELECT * FROM df")
-        conn.close()
+        # 能由预聚合表回答的查询改写为读取预聚合表，失败时回退到原始SQL
+        # 预聚合表和样本只针对 data_table，分表导入的数据集不使用
+        multi_table = "数据表" in data_info
+        used_rollup = None
+        if use_rollups and not multi_table:
+            with metrics.span('analyze_data_with_ai.rollup_rewrite'):
+                rollups = rollup.load_rollups(db_path, data_info.get('data_version', 0))
+                rewritten_sql, used_rollup = rollup.rewrite_with_rollups(sql_query, rollups)
+            if used_rollup:
+                try:
+                    result, query_profile = execute_query(db_path, rewritten_sql, profile_threshold_ms)
+                except Exception as e:
+                    print(f"预聚合表查询失败，回退到原始SQL: {str(e)}")
+                    used_rollup = None
+            metrics.inc('cache_requests_total', cache='rollup', result='hit' if used_rollup else 'miss')
 
+        # 近似模式下在样本上执行聚合查询，预聚合表能精确回答时不需要近似
+        approximate_info = None
+        if approximate and multi_table:
+            approximate_info = {"applied": False, "reason": "分表导入的数据集不支持近似查询"}
+        elif approximate and not used_rollup:
+            approximate_info = _execute_approximate(db_path, sql_query, data_info, profile_threshold_ms)
+            if approximate_info.get('applied'):
+                result, query_profile = approximate_info.pop('result'), approximate_info.pop('query_profile')
+
+        # 连接到数据库并执行查询
+        if not used_rollup and not (approximate_info and approximate_info['applied']):
+            result, query_profile = execute_query(db_path, sql_query, profile_threshold_ms)
+        
+    except Exception as e:
+        return {
+            "error": f"DuckDB查询执行失败: {str(e)}"
+        }
+    
+    if used_rollup:
+        rows_scanned = used_rollup['row_count']
+    elif approximate_info and approximate_info['applied']:
+        rows_scanned = approximate_info['sample_rows']
+    else:
+        rows_scanned = data_info['行数']
+    metrics.inc('rows_scanned_total', rows_scanned)
+    metrics.inc('rows_returned_total', len(result))
+
+    # 返回结果
+    with metrics.span('analyze_data_with_ai.to_dict'):
+        query_result = query_result_to_dict(result)
+
+    analysis = {
+        "question": question,
+        "sql_query": sql_query,
+        "data_info": data_info,
+        "result": query_result
+    }
+    if used_rollup:
+        analysis["rollup"] = {
+            "table": used_rollup["name"],
+            "executed_sql": rewritten_sql
+        }
+    if approximate_info:
+        analysis["approximate"] = approximate_info
+    if followup_info:
+        analysis["followup"] = followup_info
+    if query_profile:
+        analysis["query_profile"] = query_profile
+
+    return analysis
+
+
+def _generate_sql_with_ai(file_path, question, data_info, history_text=''):
+    """构建提示词并调用LLM生成SQL
+
+    Args:
+        file_path (str): 文件路径
+        question (str): 用户问题
+        data_info (dict): 数据概要信息
+        history_text (str): 可选，会话中之前的问答，作为追问的上下文
+
+    Returns:
+        dict: {"sql_query": 清理后的SQL} 或 {"error": 错误信息}
+    """
     # 构建 AI 提示词
     file_name = os.path.basename(file_path)
-    system_context = f"""你是一个数据分析专家。用户上传了一个名为"{file_name}"的数据文件，包含以下信息：
+    if "数据表" in data_info:
+        system_context, table_rule = _multi_table_context(file_name, data_info)
+    else:
+        system_context = f"""你是一个数据分析专家。用户上传了一个名为"{file_name}"的数据文件，包含以下信息：
 
 数据概要：
 - 行数：{data_info['行数']}
 - 列数：{data_info['列数']}
 - 列名：{', '.join(data_info['列名'])}
-- 数据类型：{data_info['数据类型']}
+- 数据类型：{data_info['数据类型']}"""
+        # 有对话上下文时之前的SQL已经展示了数据的用法，省略示例数据以缩短提示词
+        if not history_text:
+            system_context += f"""
 
 前5行数据示例：
-{pd.DataFrame(data_info['前5行数据']).to_string()}
+{pd.DataFrame(data_info['前5行数据']).to_string()}"""
+        table_rule = "表名固定为 'data_table'"
+        if "数据来源" in data_info:
+            # 来源很多时只列出前几个，避免提示词过长
+            names = [source['来源'] for source in data_info['数据来源']]
+            sources = '、'.join(names[:20]) + (f" 等{len(names)}个" if len(names) > 20 else '')
+            table_rule += f"，{ingest.SOURCE_COLUMN} 列为每行数据来自的工作表或文件（{sources}）"
+
+    if history_text:
+        system_context += f"\n\n{history_text}"
+
+    system_context += f"""
 
 请根据用户的问题生成相应的SQL查询语句。注意：
-1. 表名固定为 'data_table'
+1. {table_rule}
 2. 只返回SQL语句，不要包含其他解释
 3. SQL语句必须是DuckDB兼容的
 4. 确保SQL语句是安全的，不包含删除、更新等操作
 5. 如果问题不适合用SQL解决，请返回一个查询所有数据的SELECT语句"""
+    if history_text:
+        system_context += "\n6. 如果用户问题是对之前问题的追问，在之前SQL的基础上修改，其余部分保持不变"
 
     user_input = f"用户问题：{question}"
 
     # 调用 Gemini API 生成 SQL
     try:
-        # 初始化 Gemini
-        client = genai.Client(api_key=API_KEY)
-
-        # 生成 SQL
         prompt = f"{system_context}\n\n{user_input}"
-
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
-        )
-        
-        sql_query = response.text
+        with metrics.span('analyze_data_with_ai.llm'):
+            sql_query = generate_sql(prompt)
 
     except Exception as e:
         return {
@@ -221,40 +570,59 @@ async def analyze_data_with_ai(*, file_path: str, question: str, data_info: dict
     if sql_query.endswith('```'):
         sql_query = sql_query[:-3]
     sql_query = sql_query.strip()
-    
-    # 使用DuckDB执行SQL查询，连接到磁盘数据库
-    try:
-        # 检查数据库路径是否存在
-        db_path = data_info.get("db_path")
-        if not db_path:
-            return {
-                "error": "数据库路径不存在"
-            }
-        
-        # 检查数据库文件是否存在
-        if not os.path.exists(db_path):
-            return {
-                "error": f"数据库文件不存在: {db_path}"
-            }
-            
-        # 连接到数据库并执行查询
-        conn = duckdb.connect(db_path)
-        result = conn.execute(sql_query).fetchdf()
-        conn.close()
-        
-    except Exception as e:
-        return {
-            "error": f"DuckDB查询执行失败: {str(e)}"
-        }
-    
-    # 返回结果
     return {
-        "question": question,
-        "sql_query": sql_query,
-        "data_info": data_info,
-        "result": {
-            "columns": list(result.columns),
-            "data": result.to_dict('records'),
-            "row_count": len(result)
-        }
+        "sql_query": sql_query
     }
+
+
+def _multi_table_context(file_name, data_info):
+    """分表导入的数据集的提示词：逐个列出各表的来源、列和示例数据
+
+    Returns:
+        tuple: (数据说明, 关于表名的注意事项)
+    """
+    sections = []
+    for table in data_info['数据表']:
+        sections.append(f"""表 {table['表名']}（来自"{table['来源']}"）：
+- 行数：{table['行数']}
+- 列名：{', '.join(map(str, table['列名']))}
+- 数据类型：{table['数据类型']}
+- 前5行数据示例：
+{pd.DataFrame(table['前5行数据']).to_string()}""")
+
+    system_context = f"""你是一个数据分析专家。用户上传了一个名为"{file_name}"的数据文件，其中的每个工作表或文件导入为一个表：
+
+""" + '\n\n'.join(sections)
+    table_rule = "只能使用上面列出的表，需要时可以 JOIN 或 UNION ALL 多个表"
+    return system_context, table_rule
+
+
+def _execute_approximate(db_path, sql_query, data_info, profile_threshold_ms):
+    """尝试以近似方式执行查询
+
+    Returns:
+        dict: 近似查询的说明信息；applied 为 True 时附带 result 和 query_profile，
+            为 False 时 reason 说明未近似执行的原因
+    """
+    with metrics.span('analyze_data_with_ai.approximate_rewrite'):
+        sample = approx.load_sample(db_path, data_info.get('data_version', 0))
+        # 还没有可用的样本时先用 TABLESAMPLE，同时在后台构建样本供之后的查询使用
+        if sample is None and data_info['行数'] >= approx.MIN_ROWS:
+            sample = approx.system_sample(db_path, data_info['行数'])
+            approx.build_sample_in_background(db_path, data_info)
+        try:
+            plan = approx.plan_approximate(sql_query, sample, data_info['行数'])
+        except approx.CannotApproximate as e:
+            return {"applied": False, "reason": str(e)}
+
+    try:
+        result, query_profile = execute_query(db_path, plan['sql'], profile_threshold_ms)
+        result, error_estimates = approx.collect_error_estimates(result, plan)
+    except Exception as e:
+        print(f"近似查询失败，回退到精确查询: {str(e)}")
+        return {"applied": False, "reason": f"近似查询失败: {str(e)}"}
+
+    metrics.inc('approximate_queries_total', method=plan['method'])
+    info = approx.describe(plan, error_estimates)
+    info.update(result=result, query_profile=query_profile)
+    return info
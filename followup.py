@@ -0,0 +1,333 @@
+"""追问：利用同一会话中之前的问题和SQL
+
+用户经常在上一个问题的基础上追问，例如"只看2024年"、"按销售额降序"、"前10条"。
+本模块提供两部分功能：
+
+1. 对话上下文：把会话中最近的问题和生成的SQL按token预算整理为提示词的一部分，
+   让模型在之前SQL的基础上修改，而不是每次从头生成
+2. 本地快速路径：追问只包含筛选、排序、条数限制这类简单修改时，直接在语法树上修改
+   上一条SQL，不调用LLM。追问中有任何无法识别的内容时都交给LLM处理
+"""
+import re
+
+import sql_ast
+import storage
+
+# 提示词中最多包含的历史问答数
+HISTORY_LIMIT = 5
+
+# 对话上下文默认的token预算
+DEFAULT_CONTEXT_TOKENS = 800
+
+_CN_NUMBERS = {'一': 1, '两': 2, '二': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9, '十': 10}
+_NUMBER = r'(\d+|[一两二三四五六七八九十])'
+
+_LIMIT_PATTERNS = [
+    rf'前\s*{_NUMBER}\s*(?:条|行|个|名|项|位)?',
+    rf'(?<![a-z])top\s*{_NUMBER}',
+    rf'(?<![a-z])(?:limit|first)\s*{_NUMBER}',
+    rf'{_NUMBER}\s*(?:条|行)',
+]
+
+_DESC_WORDS = r'(?:降序|倒序|从高到低|从大到小|由高到低|由大到小)'
+_ASC_WORDS = r'(?:升序|正序|从低到高|从小到大|由低到高|由小到大)'
+_ORDER_SUFFIX = r'\s*(?:排序|排列|排)?'
+
+_COMPARISONS = [
+    # 较长的写法在前，避免 ">=" 被识别为 ">"
+    (r'>=|不少于|不低于|至少', '>='),
+    (r'<=|不超过|不高于|至多', '<='),
+    (r'!=|<>|不等于|不是', '!='),
+    (r'>|大于|超过|高于', '>'),
+    (r'<|小于|低于|少于', '<'),
+    (r'==|=|等于|为|是', '='),
+]
+
+_YEAR_PATTERN = r'(?<!\d)((?:19|20)\d{2})\s*年?(?!\d)'
+
+# 去掉已识别的修改后，剩余内容只包含这些词时才视为简单追问
+_FILLER_PATTERN = re.compile(
+    r'只看|只要|只显示|只保留|只需要|显示|仅看|仅|只|看看|看|再|然后|现在|改成|改为|换成|换为|按照|按|'
+    r'请|帮我|给我|一下|的|数据|结果|记录|排序|排列|并且|并|且|和|呢|吧|吗|就|里|中|'
+    r'(?<![a-z])(?:now|only|just|show|me|the|results?|rows?|data|please|and|then|instead|but|for|in|with|'
+    r'sorted|sort|ordered|order|by|where|filter|filtered|to|of|records?|year|limit|it)(?![a-z])|'
+    r'[\s,，.。!！?？、;；:："\'`]'
+)
+
+
+class _Unsupported(Exception):
+    """追问中包含无法在本地处理的修改"""
+
+
+def estimate_tokens(text):
+    """粗略估算文本的token数：中文约每字一个token，其他字符约每4个一个token"""
+    cjk = len(re.findall(r'[一-鿿]', text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def history_context(history, max_tokens=DEFAULT_CONTEXT_TOKENS):
+    """把最近的问答整理为提示词中的对话上下文
+
+    从最近的一条开始加入，超出token预算时丢弃更早的问答。
+
+    Args:
+        history (list): [{'question', 'sql_query'}]，按时间从早到晚排列
+        max_tokens (int): token预算
+
+    Returns:
+        str: 对话上下文，没有可用的历史时返回空字符串
+    """
+    entries = []
+    used = 0
+    for record in reversed(history or []):
+        entry = f"问题：{record['question']}\nSQL：{record['sql_query']}"
+        tokens = estimate_tokens(entry)
+        if used + tokens > max_tokens:
+            break
+        entries.append(entry)
+        used += tokens
+    if not entries:
+        return ''
+    return "之前的对话（从早到晚）：\n\n" + '\n\n'.join(reversed(entries))
+
+
+def _number(text):
+    return _CN_NUMBERS[text] if text in _CN_NUMBERS else int(text)
+
+
+def _quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _literal(value, numeric):
+    if numeric:
+        float(value)  # 不是数字时抛出 ValueError
+        return value
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _is_numeric(dtype):
+    return any(name in str(dtype).lower() for name in ('int', 'float', 'double', 'decimal'))
+
+
+def _is_date(dtype):
+    return any(name in str(dtype).lower() for name in ('date', 'time'))
+
+
+def _looks_like_dates(values):
+    """示例数据中的值是否都是日期格式的文本（CSV中的日期列读取后是文本）"""
+    values = [value for value in values if value is not None]
+    return bool(values) and all(
+        isinstance(value, str) and re.match(r'^\d{4}-\d{1,2}-\d{1,2}', value) for value in values
+    )
+
+
+class _Refiner:
+    """在上一条SQL的语法树上应用追问中的修改"""
+
+    def __init__(self, question, tree, node, data_info):
+        self.text = question.lower()
+        self.tree = tree
+        self.node = node
+        self.columns = {str(col).lower(): str(col) for col in data_info['列名']}
+        self.dtypes = {str(col).lower(): dtype for col, dtype in data_info['数据类型'].items()}
+        self.output_names = {sql_ast.output_name(e).lower(): sql_ast.output_name(e) for e in node['select_list']}
+        self.preview = data_info.get('前5行数据') or []
+        self.changes = []
+
+    def consume(self, match):
+        """从追问文本中移除已识别的部分，用等长的空格替换以保持位置不变"""
+        self.text = self.text[:match.start()] + ' ' * (match.end() - match.start()) + self.text[match.end():]
+
+    def _column_pattern(self, names):
+        # 列名按长度降序，优先匹配较长的列名
+        return '(' + '|'.join(re.escape(name) for name in sorted(names, key=len, reverse=True)) + ')'
+
+    def apply_limit(self):
+        for pattern in _LIMIT_PATTERNS:
+            match = re.search(pattern, self.text)
+            if match:
+                limit = _number(match.group(1))
+                self.consume(match)
+                modifiers = [m for m in self.node['modifiers'] if m['type'] != 'LIMIT_MODIFIER']
+                _, template = sql_ast.parse_select(f'SELECT 1 LIMIT {limit}')
+                self.node['modifiers'] = modifiers + template['modifiers']
+                self.changes.append(f"只返回前 {limit} 行")
+                return
+
+    def _order_modifier(self):
+        for modifier in self.node['modifiers']:
+            if modifier['type'] == 'ORDER_MODIFIER':
+                return modifier
+        return None
+
+    def _set_order(self, column, descending):
+        """按指定列排序，替换原有的排序"""
+        if column.lower() in self.output_names:
+            name = self.output_names[column.lower()]
+        elif column.lower() in self.columns:
+            name = self.columns[column.lower()]
+        else:
+            raise _Unsupported(f"未知的列: {column}")
+        direction = 'DESC' if descending else 'ASC'
+        _, template = sql_ast.parse_select(f'SELECT 1 ORDER BY {_quote_identifier(name)} {direction}')
+        order = template['modifiers'][0]
+        modifiers = [m for m in self.node['modifiers'] if m['type'] != 'ORDER_MODIFIER']
+        # 排序需要在条数限制之前
+        self.node['modifiers'] = [order] + modifiers
+        self.changes.append(f"按 {name} {'降序' if descending else '升序'}排列")
+
+    def apply_order(self):
+        names = set(self.output_names) | set(self.columns)
+        column = self._column_pattern(names)
+        patterns = [
+            (rf'按照?\s*{column}\s*{_DESC_WORDS}{_ORDER_SUFFIX}', True),
+            (rf'按照?\s*{column}\s*{_ASC_WORDS}{_ORDER_SUFFIX}', False),
+            (rf'(?<![a-z])(?:order|sort)(?:ed)?\s+by\s+{column}\s+(?:desc|descending)(?![a-z])', True),
+            (rf'(?<![a-z])(?:order|sort)(?:ed)?\s+by\s+{column}(?:\s+(?:asc|ascending)(?![a-z]))?', False),
+        ]
+        for pattern, descending in patterns:
+            match = re.search(pattern, self.text)
+            if match:
+                self.consume(match)
+                self._set_order(match.group(1), descending)
+                return
+
+        # 只改变排序方向，沿用原有的排序列
+        for pattern, direction in ((_DESC_WORDS, 'DESCENDING'), (_ASC_WORDS, 'ASCENDING'),
+                                   (r'(?<![a-z])(?:desc|descending)(?![a-z])', 'DESCENDING'),
+                                   (r'(?<![a-z])(?:asc|ascending)(?![a-z])', 'ASCENDING'),
+                                   (r'反过来|倒过来|(?<![a-z])reversed?(?![a-z])', 'REVERSE')):
+            match = re.search(pattern, self.text)
+            if not match:
+                continue
+            order = self._order_modifier()
+            if not order or not order['orders']:
+                raise _Unsupported("上一条SQL没有排序")
+            self.consume(match)
+            for item in order['orders']:
+                if direction == 'REVERSE':
+                    item['type'] = 'ASCENDING' if item['type'] == 'DESCENDING' else 'DESCENDING'
+                else:
+                    item['type'] = direction
+            self.changes.append({'DESCENDING': "改为降序", 'ASCENDING': "改为升序", 'REVERSE': "反转排序"}[direction])
+            return
+
+    def _add_condition(self, condition_sql, replaces=None):
+        """在WHERE中增加条件
+
+        replaces 为等值条件的左侧表达式时，去掉原有对同一表达式的等值条件（例如把2024年改为2023年）
+        """
+        condition = sql_ast.parse_expression(condition_sql)
+        kept = sql_ast.split_conjunction(self.node.get('where_clause'))
+        if replaces is not None:
+            key = sql_ast.canonical(replaces)
+            kept = [
+                part for part in kept
+                if not (part.get('type') == 'COMPARE_EQUAL' and sql_ast.canonical(part.get('left')) == key)
+            ]
+        sql = ' AND '.join(f'({sql_ast.expression_sql(part)})' for part in kept + [condition])
+        self.node['where_clause'] = sql_ast.parse_expression(sql)
+        self.changes.append(f"筛选 {condition_sql}")
+
+    def apply_comparisons(self):
+        if not self.columns:
+            return
+        column = self._column_pattern(self.columns)
+        for words, operator in _COMPARISONS:
+            pattern = rf'{column}\s*(?:{words})\s*[\'"]?([^\s\'"，,。；;]+?)[\'"]?(?=的|数据|$|[\s\'"，,。；;])'
+            while True:
+                match = re.search(pattern, self.text)
+                if not match:
+                    break
+                name = self.columns[match.group(1)]
+                # 值保持原问题中的大小写
+                value = self._original[match.start(2):match.end(2)] if self._aligned else match.group(2)
+                numeric = _is_numeric(self.dtypes.get(match.group(1)))
+                try:
+                    value_sql = _literal(value, numeric)
+                except ValueError:
+                    raise _Unsupported(f"{name} 不是数值列")
+                if not numeric and operator not in ('=', '!='):
+                    raise _Unsupported("文本列只支持等值筛选")
+                self.consume(match)
+                left = sql_ast.parse_expression(_quote_identifier(name))
+                self._add_condition(f'{_quote_identifier(name)} {operator} {value_sql}',
+                                    left if operator == '=' else None)
+
+    def apply_year(self):
+        match = re.search(_YEAR_PATTERN, self.text)
+        if not match:
+            return
+        year = int(match.group(1))
+
+        # 优先使用名为年份的数值列，其次是上一条SQL中用到的日期列，最后是数据集中唯一的日期列
+        year_columns = [col for col in ('year', '年份', '年') if col in self.columns]
+        if year_columns:
+            target = _quote_identifier(self.columns[year_columns[0]])
+        else:
+            target = f'year({self._date_expression()})'
+        self.consume(match)
+        self._add_condition(f'{target} = {year}', sql_ast.parse_expression(target))
+
+    def _date_expression(self):
+        """年份筛选使用的日期表达式：优先使用上一条SQL中用到的日期列，其次是数据集中唯一的日期列"""
+        date_columns = {}
+        for col, dtype in self.dtypes.items():
+            if col not in self.columns:
+                continue
+            name = self.columns[col]
+            if _is_date(dtype):
+                date_columns[col] = _quote_identifier(name)
+            elif _looks_like_dates([row.get(name) for row in self.preview]):
+                date_columns[col] = f'TRY_CAST({_quote_identifier(name)} AS TIMESTAMP)'
+
+        used = [col for col in date_columns if col in sql_ast.column_names(self.node)]
+        if len(used) == 1:
+            return date_columns[used[0]]
+        if len(date_columns) == 1:
+            return next(iter(date_columns.values()))
+        raise _Unsupported("无法确定年份对应的列")
+
+    def refine(self, question):
+        # 小写后长度不变时可以按位置取回原始大小写的值
+        self._original = question
+        self._aligned = len(question) == len(self.text)
+        self.apply_limit()
+        self.apply_order()
+        self.apply_comparisons()
+        self.apply_year()
+        if not self.changes or _FILLER_PATTERN.sub('', self.text):
+            raise _Unsupported("追问中有无法识别的内容")
+        return sql_ast.deparse(self.tree)
+
+
+def refine_previous_sql(question, previous_sql, data_info, db_path=None):
+    """尝试在本地把简单的追问应用到上一条SQL上
+
+    Args:
+        question (str): 追问
+        previous_sql (str): 会话中上一条SQL
+        data_info (dict): 数据概要信息
+        db_path (str): 可选，提供时检查修改后的SQL能否在数据库上绑定
+
+    Returns:
+        tuple: (修改后的SQL, 修改说明列表)，无法在本地处理时返回 (None, None)
+    """
+    tree, node = sql_ast.parse_select(previous_sql)
+    if node is None or not sql_ast.is_simple_select(node) or "数据表" in data_info:
+        return None, None
+    try:
+        refiner = _Refiner(question, tree, node, data_info)
+        sql = refiner.refine(question)
+    except _Unsupported:
+        return None, None
+
+    if db_path:
+        try:
+            with storage.connect_read(db_path) as conn:
+                conn.execute(f'DESCRIBE {sql}')
+        except Exception as e:
+            print(f"追问修改后的SQL无法执行，交给LLM处理: {str(e)}")
+            return None, None
+    return sql, refiner.changes
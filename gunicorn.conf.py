@@ -0,0 +1,24 @@
+"""生产环境多进程部署配置
+
+    gunicorn -c gunicorn.conf.py app:app
+
+每个工作进程各自打开 SQLite 和 DuckDB 连接，数据集文件的读写通过 storage 模块
+加锁协调：导入和追加时独占写入，查询时以只读方式并行访问。
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# 默认每个CPU核心一个工作进程，每个进程内再用线程处理等待LLM响应等I/O
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 4))
+
+# LLM调用和大文件导入可能耗时较长
+timeout = int(os.environ.get('TIMEOUT', 120))
+
+# 不在主进程中预加载应用，避免fork后的子进程共享数据库连接
+preload_app = False
+
+accesslog = '-'
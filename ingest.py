@@ -0,0 +1,344 @@
+"""数据文件读取与并行导入
+
+单个CSV、Parquet、JSON文件或只有一个工作表的Excel文件按原来的方式读取为一个DataFrame。
+包含多个工作表的Excel工作簿，以及打包了多个CSV / Parquet / JSON文件的 zip / tar 压缩包，
+每个工作表或压缩包成员作为一个数据来源，在进程池中并行读取，各自写成临时的Parquet文件，
+再由DuckDB流式读入数据库。导入方式有两种：
+
+- union：所有来源合并到 data_table，增加 _source 列记录每行来自哪个工作表或文件，
+  列不完全相同时按列名对齐，缺失的列为NULL
+- separate：每个来源导入为单独的表，数据概要中的"数据表"列出各表的表名、来源和列信息
+
+Excel解析是CPU密集的，并行的工作进程数默认等于CPU核数，可通过环境变量 INGEST_WORKERS 设置。
+"""
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import metrics
+import storage
+
+DATA_SUFFIXES = ('.parquet', '.csv', '.xlsx', '.xls', '.json')
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+# 压缩包中可以导入的成员文件类型
+MEMBER_SUFFIXES = ('.csv', '.parquet', '.json')
+
+# 压缩包解压后的总大小上限，防止压缩炸弹占满磁盘
+MAX_EXTRACTED_BYTES = 2 * 1024 * 1024 * 1024
+
+MAX_WORKERS = int(os.environ.get('INGEST_WORKERS') or 0) or os.cpu_count() or 1
+
+MODES = ('union', 'separate')
+SOURCE_COLUMN = '_source'
+
+# separate 模式下不能使用的表名（主表）和表名前缀（预聚合表）
+RESERVED_TABLES = {'data_table'}
+RESERVED_PREFIXES = ('rollup_',)
+
+
+def read_dataframe(file_path, sheet_name=0):
+    """根据文件类型把数据文件读取为DataFrame
+
+    Args:
+        file_path (str): 文件路径
+        sheet_name: Excel文件的工作表名称或序号，默认第一个工作表
+
+    Returns:
+        DataFrame: 读取的数据，失败时抛出异常
+    """
+    file_suffix = os.path.splitext(file_path)[1].lower()
+    if file_suffix == '.parquet':
+        return pq.read_table(file_path).to_pandas()
+    if file_suffix == '.csv':
+        return pd.read_csv(file_path)
+    if file_suffix in ('.xlsx', '.xls'):
+        engine = "openpyxl" if file_suffix == '.xlsx' else "xlrd"
+        return pd.read_excel(file_path, sheet_name=sheet_name, engine=engine)
+    if file_suffix == '.json':
+        # 尝试不同的JSON读取方式
+        try:
+            # 先尝试按行读取（每行一个JSON对象）
+            return pd.read_json(file_path, lines=True)
+        except ValueError:
+            pass
+        try:
+            # 再尝试作为JSON数组读取
+            return pd.read_json(file_path)
+        except ValueError:
+            pass
+        # 最后尝试手动解析JSON
+        with open(file_path, encoding='utf-8') as f:
+            json_data = json.load(f)
+        if isinstance(json_data, list):
+            return pd.DataFrame(json_data)
+        if isinstance(json_data, dict):
+            # 如果所有值都是列表，作为列数据处理，否则作为单行数据处理
+            if all(isinstance(v, list) for v in json_data.values()):
+                return pd.DataFrame(json_data)
+            return pd.DataFrame([json_data])
+        raise ValueError("不支持的JSON格式")
+    raise ValueError(f"不支持的文件类型: {file_suffix}")
+
+
+def archive_suffix(file_path):
+    """压缩包的扩展名，不是支持的压缩包时返回None"""
+    name = file_path.lower()
+    for suffix in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix):
+            return suffix
+    return None
+
+
+def list_sheets(file_path):
+    """Excel文件的工作表名称，不是Excel文件时返回None"""
+    file_suffix = os.path.splitext(file_path)[1].lower()
+    if file_suffix not in ('.xlsx', '.xls'):
+        return None
+    engine = "openpyxl" if file_suffix == '.xlsx' else "xlrd"
+    with pd.ExcelFile(file_path, engine=engine) as workbook:
+        return list(workbook.sheet_names)
+
+
+def is_multi_source(file_path):
+    """文件是否需要按多个来源并行导入（压缩包或包含多个工作表的Excel文件）"""
+    if archive_suffix(file_path):
+        return True
+    sheets = list_sheets(file_path)
+    return sheets is not None and len(sheets) > 1
+
+
+def _archive_members(archive_path):
+    """遍历压缩包中可以导入的成员
+
+    Yields:
+        tuple: (成员路径, 大小, 打开成员的函数)
+    """
+    def wanted(name):
+        base = os.path.basename(name)
+        return (not name.startswith('__MACOSX/') and not base.startswith('.')
+                and os.path.splitext(base)[1].lower() in MEMBER_SUFFIXES)
+
+    if archive_suffix(archive_path) == '.zip':
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and wanted(info.filename):
+                    yield info.filename, info.file_size, lambda info=info: archive.open(info)
+    else:
+        with tarfile.open(archive_path) as archive:
+            for member in archive:
+                if member.isfile() and wanted(member.name):
+                    yield member.name, member.size, lambda member=member: archive.extractfile(member)
+
+
+def _extract_members(archive_path, target_dir):
+    """把压缩包中可以导入的成员解压到目标目录
+
+    解压后的文件按序号命名，不使用成员路径，避免路径穿越。
+
+    Returns:
+        list: [(成员路径, 解压后的文件路径)]
+    """
+    members = []
+    total_size = 0
+    for name, size, open_member in _archive_members(archive_path):
+        total_size += size
+        if total_size > MAX_EXTRACTED_BYTES:
+            raise ValueError(f"压缩包解压后超过 {MAX_EXTRACTED_BYTES // (1024 * 1024)}MB")
+        path = os.path.join(target_dir, f"member_{len(members)}{os.path.splitext(name)[1].lower()}")
+        with open_member() as src, open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        members.append((name, path))
+    return members
+
+
+def _write_parquet(df, parquet_path):
+    """把DataFrame写为Parquet文件，混合类型的文本列（Excel中常见）统一转为字符串"""
+    df.columns = [str(col) for col in df.columns]
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        for col in df.columns:
+            if df[col].dtype == object:
+                df[col] = df[col].map(lambda v: None if pd.isna(v) else str(v))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, parquet_path)
+
+
+def _load_source(task):
+    """在工作进程中读取一个来源并写为Parquet文件
+
+    Args:
+        task (tuple): (来源名称, 文件路径, 工作表名称, 输出的Parquet文件路径)
+
+    Returns:
+        dict: 来源名称、Parquet文件路径、行数、列名、数据类型和前5行数据
+    """
+    name, file_path, sheet_name, parquet_path = task
+    df = read_dataframe(file_path, sheet_name)
+    _write_parquet(df, parquet_path)
+    return {
+        "name": name,
+        "parquet_path": parquet_path,
+        "行数": len(df),
+        "列名": list(df.columns),
+        "数据类型": {col: str(dtype) for col, dtype in df.dtypes.items()},
+        "前5行数据": df.head().to_dict('records')
+    }
+
+
+def _run_tasks(tasks):
+    """并行执行读取任务，只有一个任务时直接在当前进程执行"""
+    workers = min(MAX_WORKERS, len(tasks))
+    if workers <= 1:
+        return [_load_source(task) for task in tasks]
+
+    # 服务进程中有其他线程，fork可能复制到被持有的锁，使用forkserver启动工作进程，
+    # 并在forkserver中预先导入本模块，工作进程无需各自导入pandas
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+    else:
+        context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        return list(pool.map(_load_source, tasks))
+
+
+def _literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _table_names(sources):
+    """为 separate 模式的每个来源生成不重复的表名"""
+    names = []
+    for source in sources:
+        # 压缩包成员去掉目录和扩展名，工作表名称原样使用
+        base = os.path.basename(source['name'])
+        if os.path.splitext(base)[1].lower() in MEMBER_SUFFIXES:
+            base = os.path.splitext(base)[0]
+        base = re.sub(r'\W+', '_', base).strip('_').lower() or 'table'
+        if base[0].isdigit() or base in RESERVED_TABLES or base.startswith(RESERVED_PREFIXES):
+            base = f't_{base}'
+        name = base
+        suffix = 2
+        while name in names:
+            name = f'{base}_{suffix}'
+            suffix += 1
+        names.append(name)
+    return names
+
+
+def _union_data_info(sources):
+    """union 模式的数据概要：各来源的列按列名合并，类型不一致的列记为object"""
+    dtypes = {SOURCE_COLUMN: 'object'}
+    for source in sources:
+        for col, dtype in source['数据类型'].items():
+            if dtypes.setdefault(col, dtype) != dtype:
+                dtypes[col] = 'object'
+    first = sources[0]
+    return {
+        "行数": sum(source['行数'] for source in sources),
+        "列数": len(dtypes),
+        "列名": list(dtypes),
+        "数据类型": dtypes,
+        "前5行数据": [{SOURCE_COLUMN: first['name'], **row} for row in first['前5行数据']],
+        "数据来源": [{"来源": source['name'], "行数": source['行数']} for source in sources]
+    }
+
+
+def _separate_data_info(sources, table_names):
+    """separate 模式的数据概要：列名和数据类型以"表名.列名"表示，各表的详细信息在"数据表"中"""
+    tables = []
+    columns = []
+    dtypes = {}
+    for source, table in zip(sources, table_names):
+        tables.append({
+            "表名": table,
+            "来源": source['name'],
+            "行数": source['行数'],
+            "列名": source['列名'],
+            "数据类型": source['数据类型'],
+            "前5行数据": source['前5行数据']
+        })
+        for col in source['列名']:
+            columns.append(f'{table}.{col}')
+            dtypes[f'{table}.{col}'] = source['数据类型'][col]
+    return {
+        "行数": sum(source['行数'] for source in sources),
+        "列数": len(columns),
+        "列名": columns,
+        "数据类型": dtypes,
+        "前5行数据": [],
+        "数据表": tables
+    }
+
+
+def ingest_sources(file_path, db_path, mode='union'):
+    """并行导入Excel工作簿的所有工作表或压缩包中的所有数据文件
+
+    Args:
+        file_path (str): Excel文件或压缩包路径
+        db_path (str): DuckDB数据库文件路径
+        mode (str): 'union' 合并为 data_table 并增加 _source 列，'separate' 每个来源一个表
+
+    Returns:
+        dict: 数据概要信息（不含db_path），失败时抛出异常
+    """
+    if mode not in MODES:
+        raise ValueError(f"不支持的导入方式: {mode}")
+
+    # 临时文件放在数据库所在目录，与数据库使用同一块磁盘
+    work_dir = tempfile.mkdtemp(prefix='.ingest_', dir=os.path.dirname(os.path.abspath(db_path)))
+    try:
+        if archive_suffix(file_path):
+            with metrics.span('ingest.extract'):
+                members = _extract_members(file_path, work_dir)
+            tasks = [(name, path, 0, os.path.join(work_dir, f'source_{i}.parquet'))
+                     for i, (name, path) in enumerate(members)]
+            kind = 'archive_member'
+        else:
+            tasks = [(sheet, file_path, sheet, os.path.join(work_dir, f'source_{i}.parquet'))
+                     for i, sheet in enumerate(list_sheets(file_path))]
+            kind = 'sheet'
+        if not tasks:
+            raise ValueError("压缩包中没有可分析的数据文件，仅支持 csv、parquet、json 文件")
+
+        with metrics.span('ingest.parallel_load'):
+            sources = _run_tasks(tasks)
+        metrics.inc('ingested_sources_total', len(sources), kind=kind)
+
+        # 空的工作表或文件不导入
+        sources = [source for source in sources if source['行数'] > 0 and source['列名']]
+        if not sources:
+            raise ValueError("无法读取文件数据或文件为空")
+
+        with storage.connect_write(db_path, stage='ingest.duckdb_connect') as conn:
+            with metrics.span('ingest.duckdb_write'):
+                if mode == 'union':
+                    selects = [
+                        f"SELECT {_literal(source['name'])} AS {SOURCE_COLUMN}, * "
+                        f"FROM read_parquet({_literal(source['parquet_path'])})"
+                        for source in sources
+                    ]
+                    conn.execute(f"CREATE OR REPLACE TABLE data_table AS {' UNION ALL BY NAME '.join(selects)}")
+                    return _union_data_info(sources)
+
+                table_names = _table_names(sources)
+                for source, table in zip(sources, table_names):
+                    conn.execute(
+                        f'CREATE OR REPLACE TABLE "{table}" AS '
+                        f"SELECT * FROM read_parquet({_literal(source['parquet_path'])})"
+                    )
+                return _separate_data_info(sources, table_names)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
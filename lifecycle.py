@@ -0,0 +1,394 @@
+"""数据集生命周期管理
+
+每次上传都会在 uploads/ 中留下原始文件和 data_*.duckdb 文件，如果不清理，磁盘会被
+持续占满并拖慢服务主机的I/O。本模块定期执行一次清理（sweep）：
+
+1. 清理孤儿文件：会话已被删除的文件记录及其数据文件，以及 uploads/ 中不属于任何文件记录的文件
+2. 按TTL淘汰长时间未被查询的数据集
+3. 可选地将冷数据集压缩为 zstd 压缩的 Parquet 文件：删除原始上传文件，DuckDB 文件中的
+   data_table 改为读取 Parquet 的视图，查询无需任何改动
+4. 按单个会话配额、全局配额和磁盘最小剩余空间，以最近查询时间为序淘汰最久未使用的数据集
+
+被淘汰的数据集只删除磁盘文件，文件记录标记为已清理，聊天历史仍可正常查看。
+多个工作进程同时运行时，通过 uploads/ 下的锁文件保证同一时刻只有一个清理任务。
+
+也可以单独运行（例如配置为定时任务）：
+
+    python lifecycle.py
+"""
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import duckdb
+
+import metrics
+import storage
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+SWEEP_LOCK_NAME = '.lifecycle.lock'
+
+# 新上传的文件在写入文件记录之前也不属于任何记录，超过该时间才视为孤儿文件
+ORPHAN_GRACE_SECONDS = 3600
+
+# 最近该时间内被查询过的数据集正在使用中，不按配额淘汰
+RECENTLY_USED_SECONDS = 300
+
+_sweep_lock = threading.Lock()
+
+MB = 1024 * 1024
+
+
+def policy_from_env():
+    """从环境变量读取清理策略，未设置的项不启用
+
+    Returns:
+        dict: 可直接传给 sweep 的关键字参数
+    """
+    def number(name, scale=1):
+        value = os.environ.get(name)
+        return float(value) * scale if value else None
+
+    return {
+        'ttl_hours': number('DATASET_TTL_HOURS'),
+        'compact_after_hours': number('COMPACT_AFTER_HOURS'),
+        'session_quota_bytes': number('SESSION_QUOTA_MB', MB),
+        'global_quota_bytes': number('GLOBAL_QUOTA_MB', MB),
+        'min_free_bytes': number('MIN_FREE_DISK_MB', MB),
+    }
+
+
+def dataset_paths(file_detail):
+    """数据集在磁盘上的所有文件"""
+    data_info = file_detail.get('data_info') or {}
+    paths = [file_detail.get('filepath')]
+    if data_info.get('db_path'):
+        paths.extend(storage.database_files(data_info['db_path']))
+    paths.append(data_info.get('compacted_path'))
+    return [path for path in paths if path]
+
+
+def dataset_size(file_detail):
+    """数据集在磁盘上占用的字节数"""
+    return sum(os.path.getsize(path) for path in dataset_paths(file_detail) if os.path.exists(path))
+
+
+def remove_dataset_files(file_detail):
+    """删除数据集的原始文件、DuckDB文件和压缩后的Parquet文件
+
+    Returns:
+        int: 释放的字节数
+    """
+    freed = 0
+    data_info = file_detail.get('data_info') or {}
+    if data_info.get('db_path'):
+        # 等待正在进行的查询结束后再删除
+        freed += storage.remove_database(data_info['db_path'])
+    for path in (file_detail.get('filepath'), data_info.get('compacted_path')):
+        if path and os.path.exists(path):
+            freed += os.path.getsize(path)
+            os.remove(path)
+    return freed
+
+
+def compact_dataset(db, file_detail):
+    """将数据集压缩为Parquet文件
+
+    data_table 被替换为读取Parquet文件的视图，数据集上的预聚合表和样本随之删除。
+
+    Returns:
+        int: 释放的字节数
+    """
+    data_info = dict(file_detail['data_info'])
+    db_path = data_info['db_path']
+    parquet_path = os.path.splitext(db_path)[0] + '.parquet'
+    size_before = dataset_size(file_detail)
+
+    with metrics.span('lifecycle.compact'):
+        with storage.lock_exclusive(db_path):
+            conn = duckdb.connect(db_path)
+            try:
+                conn.execute(f"COPY data_table TO '{parquet_path}' (FORMAT parquet, COMPRESSION zstd)")
+            finally:
+                conn.close()
+
+            for path in storage.database_files(db_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            conn = duckdb.connect(db_path)
+            try:
+                conn.execute(
+                    f"CREATE VIEW data_table AS SELECT * FROM read_parquet('{os.path.abspath(parquet_path)}')"
+                )
+            finally:
+                conn.close()
+
+    # 数据已保存在Parquet文件中，原始上传文件不再需要
+    if file_detail.get('filepath') and os.path.exists(file_detail['filepath']):
+        os.remove(file_detail['filepath'])
+
+    data_info['compacted_path'] = parquet_path
+    data_info['data_version'] = data_info.get('data_version', 0) + 1
+    db.update_file_info(file_detail['id'], data_info, touch_session=False)
+    file_detail['data_info'] = data_info
+
+    metrics.inc('datasets_compacted_total')
+    return max(size_before - dataset_size(file_detail), 0)
+
+
+def restore_compacted(conn, data_info):
+    """将压缩后的数据集还原为普通表，需在写连接中调用（例如追加数据前）
+
+    Returns:
+        str: 还原后可以删除的Parquet文件路径，数据集未压缩时返回None
+    """
+    parquet_path = data_info.get('compacted_path')
+    if not parquet_path:
+        return None
+    conn.execute('DROP VIEW IF EXISTS data_table')
+    conn.execute(f"CREATE TABLE data_table AS SELECT * FROM read_parquet('{os.path.abspath(parquet_path)}')")
+    return parquet_path
+
+
+def evict_dataset(db, file_detail, reason):
+    """淘汰数据集：删除磁盘文件并标记文件记录
+
+    Returns:
+        int: 释放的字节数
+    """
+    freed = remove_dataset_files(file_detail)
+    db.mark_file_evicted(file_detail['id'])
+    metrics.inc('datasets_evicted_total', reason=reason)
+    print(f"数据集已淘汰（{reason}）: {file_detail['filename']}，释放 {freed / MB:.1f} MB")
+    return freed
+
+
+def _last_used(file_detail):
+    value = file_detail.get('last_accessed_at') or file_detail.get('created_at')
+    return datetime.fromisoformat(value) if value else datetime.min
+
+
+def _age_hours(file_detail, now):
+    return (now - _last_used(file_detail)).total_seconds() / 3600
+
+
+def collect_orphans(db, upload_folder, files, grace_seconds=ORPHAN_GRACE_SECONDS):
+    """清理孤儿文件记录和孤儿文件
+
+    Args:
+        db (ChatDatabase): 数据库
+        upload_folder (str): 上传目录
+        files (list): get_all_file_details 返回的文件详情，会移除其中的孤儿记录
+        grace_seconds (int): 未被引用的文件超过该时间才删除
+
+    Returns:
+        int: 释放的字节数
+    """
+    freed = 0
+
+    # 会话已被删除的文件记录
+    orphaned = [f for f in files if not f['session_exists']]
+    for file_detail in orphaned:
+        freed += remove_dataset_files(file_detail)
+        files.remove(file_detail)
+    if orphaned:
+        db.delete_file_records([f['id'] for f in orphaned])
+
+    # 不属于任何文件记录的文件
+    referenced = {SWEEP_LOCK_NAME}
+    for file_detail in files:
+        for path in dataset_paths(file_detail):
+            referenced.add(os.path.basename(path))
+        if file_detail['data_info'].get('db_path'):
+            referenced.add(os.path.basename(storage.lock_path(file_detail['data_info']['db_path'])))
+
+    now = time.time()
+    removed = 0
+    for name in os.listdir(upload_folder):
+        path = os.path.join(upload_folder, name)
+        if name in referenced or not os.path.isfile(path):
+            continue
+        if now - os.path.getmtime(path) < grace_seconds:
+            continue
+        if name.endswith('.duckdb'):
+            freed += storage.remove_database(path)
+        elif name.endswith('.duckdb.lock'):
+            # 锁文件需在持有锁时删除；数据库文件仍在时随数据库文件一起清理
+            db_path = path[:-len('.lock')]
+            if os.path.exists(db_path):
+                continue
+            storage.remove_database(db_path)
+        elif os.path.exists(path):
+            freed += os.path.getsize(path)
+            os.remove(path)
+        removed += 1
+
+    if removed or orphaned:
+        metrics.inc('orphan_files_removed_total', removed + len(orphaned))
+    return freed
+
+
+@contextmanager
+def _try_sweep_lock(upload_folder):
+    """尝试获取清理锁，已有其他进程或线程正在清理时返回False"""
+    if not _sweep_lock.acquire(blocking=False):
+        yield False
+        return
+    try:
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(upload_folder, SWEEP_LOCK_NAME), 'a+') as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    finally:
+        _sweep_lock.release()
+
+
+def sweep(db, upload_folder, ttl_hours=None, compact_after_hours=None, session_quota_bytes=None,
+          global_quota_bytes=None, min_free_bytes=None, orphan_grace_seconds=ORPHAN_GRACE_SECONDS):
+    """执行一次清理
+
+    Args:
+        db (ChatDatabase): 数据库
+        upload_folder (str): 上传目录
+        ttl_hours (float): 超过该时长未被查询的数据集被淘汰
+        compact_after_hours (float): 超过该时长未被查询的数据集压缩为Parquet
+        session_quota_bytes (float): 单个会话的数据集占用空间上限
+        global_quota_bytes (float): 所有数据集的占用空间上限
+        min_free_bytes (float): 上传目录所在磁盘的最小剩余空间
+        orphan_grace_seconds (int): 未被引用的文件超过该时间才删除
+
+    Returns:
+        dict: 清理报告 {'freed_bytes', 'evicted', 'compacted'}，其他进程正在清理时返回None
+    """
+    with _try_sweep_lock(upload_folder) as acquired:
+        if not acquired:
+            return None
+        with metrics.span('lifecycle.sweep'):
+            report = _sweep(db, upload_folder, ttl_hours, compact_after_hours, session_quota_bytes,
+                            global_quota_bytes, min_free_bytes, orphan_grace_seconds)
+    metrics.inc('lifecycle_freed_bytes_total', report['freed_bytes'])
+    return report
+
+
+def _sweep(db, upload_folder, ttl_hours, compact_after_hours, session_quota_bytes,
+           global_quota_bytes, min_free_bytes, orphan_grace_seconds):
+    report = {'freed_bytes': 0, 'evicted': [], 'compacted': []}
+    files = db.get_all_file_details()
+    report['freed_bytes'] += collect_orphans(db, upload_folder, files, orphan_grace_seconds)
+    now = datetime.now()
+
+    def evict(file_detail, reason):
+        freed = evict_dataset(db, file_detail, reason)
+        report['freed_bytes'] += freed
+        report['evicted'].append({'id': file_detail['id'], 'filename': file_detail['filename'], 'reason': reason})
+        files.remove(file_detail)
+        return freed
+
+    if ttl_hours is not None:
+        for file_detail in [f for f in files if _age_hours(f, now) > ttl_hours]:
+            evict(file_detail, 'ttl')
+
+    if compact_after_hours is not None:
+        for file_detail in files:
+            data_info = file_detail['data_info']
+            # 分表导入的数据集没有 data_table，不压缩
+            if (data_info.get('compacted_path') or not data_info.get('db_path') or '数据表' in data_info
+                    or not os.path.exists(data_info['db_path'])
+                    or _age_hours(file_detail, now) <= compact_after_hours):
+                continue
+            try:
+                report['freed_bytes'] += compact_dataset(db, file_detail)
+                report['compacted'].append({'id': file_detail['id'], 'filename': file_detail['filename']})
+            except Exception as e:
+                print(f"数据集压缩失败: {file_detail['filename']}: {str(e)}")
+
+    sizes = {f['id']: dataset_size(f) for f in files}
+    # 按最近查询时间从旧到新排列，最近仍在使用的数据集不参与配额淘汰
+    candidates = [f for f in sorted(files, key=_last_used)
+                  if _age_hours(f, now) * 3600 > RECENTLY_USED_SECONDS]
+
+    if session_quota_bytes is not None:
+        usage = {}
+        for file_detail in files:
+            usage[file_detail['session_id']] = usage.get(file_detail['session_id'], 0) + sizes[file_detail['id']]
+        for file_detail in list(candidates):
+            if usage[file_detail['session_id']] > session_quota_bytes:
+                usage[file_detail['session_id']] -= sizes[file_detail['id']]
+                evict(file_detail, 'session_quota')
+                candidates.remove(file_detail)
+
+    if global_quota_bytes is not None:
+        total = sum(sizes[f['id']] for f in files)
+        for file_detail in list(candidates):
+            if total <= global_quota_bytes:
+                break
+            total -= sizes[file_detail['id']]
+            evict(file_detail, 'global_quota')
+            candidates.remove(file_detail)
+
+    if min_free_bytes is not None:
+        free = shutil.disk_usage(upload_folder).free
+        for file_detail in list(candidates):
+            if free >= min_free_bytes:
+                break
+            free += evict(file_detail, 'disk_pressure')
+
+    return report
+
+
+def sweep_in_background(db, upload_folder, **policy):
+    """在后台线程中执行一次清理，已有清理任务在运行时直接返回"""
+    def run():
+        try:
+            sweep(db, upload_folder, **policy)
+        except Exception as e:
+            print(f"数据集清理失败: {str(e)}")
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def start_periodic_sweeps(db, upload_folder, interval_seconds, **policy):
+    """启动后台线程，每隔 interval_seconds 秒执行一次清理"""
+    def run():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                sweep(db, upload_folder, **policy)
+            except Exception as e:
+                print(f"数据集清理失败: {str(e)}")
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from database import ChatDatabase
+
+    parser = argparse.ArgumentParser(description='清理过期和超出配额的数据集，策略通过环境变量配置')
+    parser.add_argument('--upload-folder', default='uploads', help='上传目录')
+    parser.add_argument('--db', default='chat_history.db', help='聊天记录数据库文件')
+    args = parser.parse_args()
+
+    result = sweep(ChatDatabase(args.db), args.upload_folder, **policy_from_env())
+    if result is None:
+        print('已有清理任务正在运行')
+    else:
+        print(f"释放 {result['freed_bytes'] / MB:.1f} MB，"
+              f"淘汰 {len(result['evicted'])} 个数据集，压缩 {len(result['compacted'])} 个数据集")
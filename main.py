@@ -1,29 +1,281 @@
+"""命令行入口
+
+    python main.py sales.csv -q "销售额最高的地区？" -q "每月订单数" --format json
+
+不带问题参数运行时进入交互模式；标准输入不是终端时逐行读取问题。
+
+数据文件导入后的DuckDB数据库和每个问题生成的SQL缓存在本地（默认 ~/.cache/ai-duckdb，
+可通过 --cache-dir 或环境变量 AI_DUCKDB_CACHE_DIR 修改），以文件路径、修改时间和大小为键，
+文件变化后自动失效。再次运行时不再重新导入文件，重复的问题直接执行缓存的SQL而不调用LLM。
+
+pandas、genai SDK 等较重的依赖只在需要导入文件或调用LLM时才加载，缓存命中时启动很快。
+"""
+import argparse
 import asyncio
-from doc import analyze_data_with_ai
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ai-duckdb')
+
+DATA_INFO_FILE = 'data_info.json'
+QUESTIONS_FILE = 'questions.json'
+DB_FILE = 'data.duckdb'
+
+
+def _write_json(path, value):
+    """原子地写入JSON文件，避免并发运行时读到写了一半的文件"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, ensure_ascii=False, default=str)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path, default):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def normalize_question(question):
+    """规范化问题文本，作为SQL缓存的键"""
+    return ' '.join(question.split())
+
+
+class DatasetCache:
+    """单个数据文件的本地缓存：导入后的DuckDB数据库和问题到SQL的映射"""
+
+    def __init__(self, cache_dir, file_path):
+        self.file_path = os.path.abspath(file_path)
+        stat = os.stat(self.file_path)
+        self.fingerprint = {'source': self.file_path, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        key = hashlib.sha1(json.dumps(self.fingerprint, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        self.cache_dir = cache_dir
+        self.entry_dir = os.path.join(cache_dir, key)
+        self.db_path = os.path.join(self.entry_dir, DB_FILE)
+        self._questions = None
+
+    def load_data_info(self):
+        """读取缓存的数据概要信息，缓存不存在或已失效时返回None"""
+        cached = _read_json(os.path.join(self.entry_dir, DATA_INFO_FILE), None)
+        if not cached or cached.get('fingerprint') != self.fingerprint or not os.path.exists(self.db_path):
+            return None
+        return cached['data_info']
+
+    def save_data_info(self, data_info):
+        _write_json(os.path.join(self.entry_dir, DATA_INFO_FILE), {
+            'fingerprint': self.fingerprint,
+            'data_info': data_info
+        })
+        self._remove_stale_entries()
+
+    def _remove_stale_entries(self):
+        """删除同一文件旧版本的缓存"""
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if entry_dir == self.entry_dir:
+                continue
+            cached = _read_json(os.path.join(entry_dir, DATA_INFO_FILE), None)
+            if cached and cached.get('fingerprint', {}).get('source') == self.file_path:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def get_sql(self, question):
+        if self._questions is None:
+            self._questions = _read_json(os.path.join(self.entry_dir, QUESTIONS_FILE), {})
+        return self._questions.get(normalize_question(question))
+
+    def save_sql(self, question, sql_query):
+        # 重新读取，尽量保留并发运行写入的其他问题
+        self._questions = _read_json(os.path.join(self.entry_dir, QUESTIONS_FILE), {})
+        self._questions[normalize_question(question)] = sql_query
+        _write_json(os.path.join(self.entry_dir, QUESTIONS_FILE), self._questions)
+
+
+async def ensure_ingested(cache):
+    """确保数据文件已导入缓存的DuckDB数据库
+
+    Returns:
+        tuple: (数据概要信息, 错误信息)
+    """
+    data_info = cache.load_data_info()
+    if data_info is not None:
+        return data_info, None
+
+    from doc import analyze_file
+
+    os.makedirs(cache.entry_dir, exist_ok=True)
+    result = await analyze_file(file_path=cache.file_path, db_path=cache.db_path)
+    if 'error' in result:
+        return None, result['error']
+    cache.save_data_info(result['data_info'])
+    return result['data_info'], None
+
+
+def run_cached_sql(db_path, sql_query):
+    """直接执行缓存的SQL，不加载pandas和LLM相关依赖"""
+    import storage
+
+    with storage.connect_read(db_path) as conn:
+        cursor = conn.execute(sql_query)
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+    return {
+        'columns': columns,
+        'data': [dict(zip(columns, row)) for row in rows],
+        'row_count': len(rows)
+    }
+
+
+async def answer(cache, data_info, question, use_cache=True):
+    """回答一个问题，缓存中有该问题的SQL时不调用LLM
+
+    Returns:
+        dict: {'question', 'sql_query', 'cached', 'result'} 或 {'question', 'error'}
+    """
+    sql_query = cache.get_sql(question) if use_cache else None
+    if sql_query:
+        try:
+            return {
+                'question': question,
+                'sql_query': sql_query,
+                'cached': True,
+                'result': run_cached_sql(cache.db_path, sql_query)
+            }
+        except Exception as e:
+            # 缓存的SQL失效（例如DuckDB版本变化）时重新生成
+            print(f"缓存的SQL执行失败，重新生成: {str(e)}", file=sys.stderr)
+
+    from doc import analyze_data_with_ai
+
+    result = await analyze_data_with_ai(
+        file_path=cache.file_path,
+        question=question,
+        data_info=data_info
+    )
+    if 'error' in result:
+        return {'question': question, 'error': result['error']}
+
+    cache.save_sql(question, result['sql_query'])
+    return {
+        'question': question,
+        'sql_query': result['sql_query'],
+        'cached': False,
+        'result': result['result']
+    }
+
+
+def print_text(answer_result, data_info, max_rows):
+    if 'error' in answer_result:
+        print(f"错误: {answer_result['error']}")
+        return
+
+    result = answer_result['result']
+    cached = '（缓存）' if answer_result['cached'] else ''
+    print(f"\n问题: {answer_result['question']}")
+    print(f"生成的SQL{cached}: {answer_result['sql_query']}")
+    print(f"\n数据信息:")
+    print(f"- 行数: {data_info['行数']}")
+    print(f"- 列数: {data_info['列数']}")
+    print(f"- 列名: {', '.join(data_info['列名'])}")
+    print(f"\n查询结果 ({result['row_count']} 行):")
+    for row in result['data'][:max_rows]:
+        print(row)
+    if result['row_count'] > max_rows:
+        print(f"... 共 {result['row_count']} 行，仅显示前 {max_rows} 行")
+
+
+def print_json(answer_result):
+    # 每个问题输出一行JSON，便于脚本逐行处理
+    print(json.dumps(answer_result, ensure_ascii=False, default=str))
+
+
+def print_csv(answer_result, with_header):
+    if 'error' in answer_result:
+        print(f"错误: {answer_result['error']}", file=sys.stderr)
+        return
+
+    result = answer_result['result']
+    if with_header:
+        print(f"# {answer_result['question']}")
+    writer = csv.writer(sys.stdout)
+    writer.writerow(result['columns'])
+    for row in result['data']:
+        writer.writerow([row.get(column) for column in result['columns']])
+
+
+def iter_questions(args):
+    """命令行参数中的问题，没有时从交互输入或标准输入读取"""
+    if args.question:
+        yield from args.question
+        return
+    if args.questions_file:
+        with open(args.questions_file, encoding='utf-8') as f:
+            yield from (line.strip() for line in f if line.strip())
+        return
+    if not sys.stdin.isatty():
+        yield from (line.strip() for line in sys.stdin if line.strip())
+        return
+    while True:
+        try:
+            question = input("请输入您的问题（直接回车退出）: ").strip()
+        except EOFError:
+            return
+        if not question:
+            return
+        yield question
 
 
 async def main():
-    print("Hello from ai-duckdb!")
+    parser = argparse.ArgumentParser(description='用自然语言分析数据文件')
+    parser.add_argument('file', nargs='?', help='数据文件路径（CSV、Excel、Parquet、JSON 或其 zip / tar 压缩包）')
+    parser.add_argument('-q', '--question', action='append', help='要回答的问题，可重复指定')
+    parser.add_argument('--questions-file', help='问题列表文件，每行一个问题')
+    parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text', help='输出格式')
+    parser.add_argument('--max-rows', type=int, default=20, help='text 格式最多显示的结果行数')
+    parser.add_argument('--cache-dir', default=os.environ.get('AI_DUCKDB_CACHE_DIR', DEFAULT_CACHE_DIR),
+                        help='导入数据和SQL的缓存目录')
+    parser.add_argument('--no-sql-cache', action='store_true', help='总是调用LLM重新生成SQL')
+    args = parser.parse_args()
+
+    file_path = args.file
+    if not file_path:
+        print("Hello from ai-duckdb!")
+        file_path = input("请输入数据文件路径: ").strip()
+    if not os.path.isfile(file_path):
+        print(f"错误: 文件不存在: {file_path}", file=sys.stderr)
+        return 1
+
+    cache = DatasetCache(args.cache_dir, file_path)
+    data_info, error = await ensure_ingested(cache)
+    if error:
+        print(f"错误: {error}", file=sys.stderr)
+        return 1
 
-    # 示例：分析数据文件
-    file_path = input("请输入数据文件路径: ")
-    question = input("请输入您的问题: ")
+    # 只有一个问题时CSV输出不加问题标题行，便于直接作为CSV文件使用
+    multiple = not (args.question and len(args.question) == 1)
+    exit_code = 0
+    for i, question in enumerate(iter_questions(args)):
+        answer_result = await answer(cache, data_info, question, use_cache=not args.no_sql_cache)
+        if 'error' in answer_result:
+            exit_code = 1
 
-    result = await analyze_data_with_ai(file_path=file_path, question=question)
+        if args.format == 'json':
+            print_json(answer_result)
+        elif args.format == 'csv':
+            if i > 0:
+                print()
+            print_csv(answer_result, with_header=multiple)
+        else:
+            print_text(answer_result, data_info, args.max_rows)
+        sys.stdout.flush()
 
-    if "error" in result:
-        print(f"错误: {result['error']}")
-    else:
-        print(f"\n问题: {result['question']}")
-        print(f"生成的SQL: {result['sql_query']}")
-        print(f"\n数据信息:")
-        print(f"- 行数: {result['data_info']['行数']}")
-        print(f"- 列数: {result['data_info']['列数']}")
-        print(f"- 列名: {', '.join(result['data_info']['列名'])}")
-        print(f"\n查询结果 ({result['result']['row_count']} 行):")
-        for row in result['result']['data'][:5]:  # 显示前5行
-            print(row)
+    return exit_code
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,181 @@
+"""分阶段耗时与计数指标
+
+提供两类数据：
+- 进程级的累计指标（耗时直方图和计数器），通过 /metrics 以 Prometheus 文本格式暴露
+- 单次请求的分阶段耗时明细，随聊天记录一起保存，便于事后分析慢请求
+
+用法：
+
+    with metrics.track_request('ask_question') as breakdown:
+        with metrics.span('ask_question.llm'):
+            ...
+        metrics.inc('rows_returned_total', 10)
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+PREFIX = 'ai_duckdb_'
+
+# 耗时直方图的分桶上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# 指标说明，用于 Prometheus 的 HELP 行
+DESCRIPTIONS = {
+    'stage_duration_seconds': '各处理阶段的耗时',
+    'cache_requests_total': '缓存访问次数，按缓存类型和是否命中区分',
+    'llm_tokens_total': 'LLM 消耗的token数，按输入/输出区分',
+    'llm_requests_total': 'LLM 调用次数',
+    'rows_scanned_total': '查询扫描的数据行数（按数据集总行数估算）',
+    'rows_returned_total': '查询返回的数据行数',
+    'requests_total': '接口请求次数，按接口和状态码区分',
+    'ingested_sources_total': '并行导入的Excel工作表和压缩包成员数量',
+    'followup_requests_total': '带有对话历史的提问次数，按本地修改上一条SQL或调用LLM区分',
+    'rollups_built_total': '构建的预聚合表数量',
+    'samples_built_total': '构建的近似查询样本数量',
+    'approximate_queries_total': '近似执行的查询次数，按近似方式区分',
+    'datasets_evicted_total': '被淘汰的数据集数量，按淘汰原因区分',
+    'datasets_compacted_total': '压缩为Parquet的数据集数量',
+    'orphan_files_removed_total': '清理的孤儿文件和文件记录数量',
+    'lifecycle_freed_bytes_total': '数据集清理释放的磁盘空间（字节）',
+    'slow_queries_profiled_total': '超过阈值并保存了查询画像的查询次数',
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_current_request = ContextVar('current_request', default=None)
+_request_started = ContextVar('request_started', default=None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _label_key(name, labels):
+    """请求明细中使用的计数器名称，例如 cache_requests_total{cache=data_info,result=hit}"""
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}={v}' for k, v in sorted(labels.items())) + '}'
+
+
+def inc(name, value=1, **labels):
+    """累加计数器，同时计入当前请求的明细"""
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+    breakdown = _current_request.get()
+    if breakdown is not None:
+        counters = breakdown['counters']
+        label_key = _label_key(name, labels)
+        counters[label_key] = counters.get(label_key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """记录一次耗时到直方图"""
+    with _lock:
+        key = _key(name, labels)
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+@contextmanager
+def span(stage):
+    """记录代码块的耗时，计入直方图和当前请求的明细（毫秒）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe('stage_duration_seconds', elapsed, stage=stage)
+        breakdown = _current_request.get()
+        if breakdown is not None:
+            stages = breakdown['stages']
+            stages[stage] = round(stages.get(stage, 0) + elapsed * 1000, 3)
+
+
+def timed(stage):
+    """装饰器：记录异步函数的整体耗时"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def track_request(name):
+    """开始记录一次请求的分阶段明细，返回的字典会在请求过程中被填充"""
+    breakdown = {'stages': {}, 'counters': {}}
+    token = _current_request.set(breakdown)
+    started = _request_started.set(time.perf_counter())
+    try:
+        with span(name):
+            yield breakdown
+    finally:
+        _request_started.reset(started)
+        _current_request.reset(token)
+
+
+def request_elapsed_ms():
+    """当前请求开始至今的耗时（毫秒），不在请求中时返回None
+
+    请求的整体耗时要等 track_request 结束才计入明细，需要在请求结束前保存端到端耗时时使用
+    """
+    started = _request_started.get()
+    if started is None:
+        return None
+    return round((time.perf_counter() - started) * 1000, 3)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for k, v in labels:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{k}="{v}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_prometheus():
+    """以 Prometheus 文本格式输出当前进程的所有指标"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']}
+                      for key, h in _histograms.items()}
+
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        full_name = PREFIX + name
+        lines.append(f'# HELP {full_name} {DESCRIPTIONS.get(name, name)}')
+        lines.append(f'# TYPE {full_name} counter')
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f'{full_name}{_format_labels(labels)} {value}')
+
+    for name in sorted({name for name, _ in histograms}):
+        full_name = PREFIX + name
+        lines.append(f'# HELP {full_name} {DESCRIPTIONS.get(name, name)}')
+        lines.append(f'# TYPE {full_name} histogram')
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                lines.append(f'{full_name}_bucket{_format_labels(labels + (("le", bound),))} {count}')
+            lines.append(f'{full_name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+            lines.append(f'{full_name}_sum{_format_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{full_name}_count{_format_labels(labels)} {histogram["count"]}')
+
+    return '\n'.join(lines) + '\n'
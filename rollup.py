@@ -0,0 +1,424 @@
+"""预聚合（rollup）表
+
+大部分提问都是"按几个维度分组求和"，每次都要全表扫描 data_table。本模块：
+
+1. 从聊天记录中挖掘高频的 GROUP BY 查询形状（分组维度 + 聚合的度量）
+2. 在后台为高频形状在数据集的DuckDB文件中物化预聚合表（rollup_xxx），
+   元数据记录在 _rollups 表中
+3. 执行查询前，将能由预聚合表回答的生成SQL透明地改写为读取预聚合表
+
+预聚合表按"维度 = 分组表达式 + WHERE中引用的列"构建，保存每个度量的
+sum/count/min/max 以及总行数，因此维度更少或带维度过滤的查询都可以在其上重新聚合。
+数据集追加数据后预聚合表会被删除，按新的数据版本重新构建。
+"""
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+import metrics
+import sql_ast
+import storage
+
+META_TABLE = '_rollups'
+
+# 可以由预聚合表重新聚合得到的聚合函数
+SUPPORTED_AGGREGATES = {'sum', 'count', 'count_star', 'min', 'max', 'avg'}
+
+# 预聚合表行数超过原表的该比例时不值得物化
+MAX_ROLLUP_RATIO = 0.2
+
+ROWS_COLUMN = '__rows'
+
+_building = set()
+_building_lock = threading.Lock()
+_metadata_cache = {}
+_metadata_cache_lock = threading.Lock()
+
+
+class CannotRewrite(Exception):
+    """查询无法由预聚合表回答"""
+
+
+def _group_expressions(node):
+    """SELECT节点的分组表达式，GROUP BY 1 这类位置引用会解析为对应的SELECT列"""
+    select_list = node['select_list']
+    if node.get('aggregate_handling') == 'FORCE_AGGREGATES':
+        # GROUP BY ALL：按所有不含聚合函数的SELECT列分组
+        return [item for item in select_list if not sql_ast.find_aggregates(item)]
+
+    groups = []
+    for expression in _resolve_group_aliases(node):
+        position = sql_ast.constant_value(expression)
+        if isinstance(position, int) and 1 <= position <= len(select_list):
+            groups.append(select_list[position - 1])
+        else:
+            groups.append(expression)
+    return groups
+
+
+def _resolve_group_aliases(node):
+    """将 GROUP BY 中引用SELECT列别名的列引用替换为对应的表达式"""
+    aliases = {item['alias'].lower(): item for item in node['select_list'] if item.get('alias')}
+    groups = []
+    for expression in node.get('group_expressions') or []:
+        item = None
+        if expression.get('class') == 'COLUMN_REF' and len(expression['column_names']) == 1:
+            item = aliases.get(expression['column_names'][0].lower())
+        if item is not None and item.get('class') != 'COLUMN_REF':
+            groups.append(dict(sql_ast.clone(item), alias=''))
+        else:
+            groups.append(expression)
+    return groups
+
+
+def extract_shape(sql):
+    """提取查询的形状
+
+    Returns:
+        dict: {'dims': {规范化表达式: SQL文本}, 'measures': {规范化表达式: {'sql': SQL文本, 'aggregates': set}}}
+            查询不是可预聚合的简单分组聚合时返回None
+    """
+    _, node = sql_ast.parse_select(sql)
+    if node is None or not sql_ast.is_simple_select(node):
+        return None
+    if any(m['type'] not in ('ORDER_MODIFIER', 'LIMIT_MODIFIER') for m in node.get('modifiers', [])):
+        return None
+    if sql_ast.contains_class(node['select_list'], {'WINDOW', 'SUBQUERY', 'STAR'}):
+        return None
+
+    aggregates = sql_ast.find_aggregates([node['select_list'], node.get('having'),
+                                          node.get('modifiers')])
+    groups = _group_expressions(node)
+    if not aggregates and not groups:
+        return None
+
+    measures = {}
+    for aggregate in aggregates:
+        name = aggregate['function_name'].lower()
+        if (name not in SUPPORTED_AGGREGATES or aggregate.get('distinct') or aggregate.get('filter')
+                or (aggregate.get('order_bys') or {}).get('orders')):
+            return None
+        if name == 'count_star':
+            continue
+        if len(aggregate['children']) != 1 or sql_ast.find_aggregates(aggregate['children']):
+            return None
+        child = aggregate['children'][0]
+        key = sql_ast.canonical(child)
+        measure = measures.setdefault(key, {'sql': sql_ast.expression_sql(child), 'aggregates': set()})
+        measure['aggregates'].add(name)
+
+    dims = {}
+    for expression in groups:
+        dims[sql_ast.canonical(expression)] = sql_ast.expression_sql(expression)
+    for name in sorted(sql_ast.column_names(node.get('where_clause'))):
+        expression = sql_ast.column_ref(name)
+        dims[sql_ast.canonical(expression)] = sql_ast.expression_sql(expression)
+
+    return {'dims': dims, 'measures': measures}
+
+
+def mine_frequent_shapes(queries, min_queries):
+    """统计历史查询中出现次数不少于 min_queries 的查询形状，按出现次数降序排列"""
+    shapes = {}
+    for sql in queries:
+        if not sql:
+            continue
+        shape = extract_shape(sql)
+        if shape is None or not shape['dims']:
+            continue
+        key = tuple(sorted(shape['dims']))
+        entry = shapes.setdefault(key, {'dims': shape['dims'], 'measures': {}, 'count': 0})
+        entry['count'] += 1
+        for measure_key, measure in shape['measures'].items():
+            merged = entry['measures'].setdefault(measure_key, {'sql': measure['sql'], 'aggregates': set()})
+            merged['aggregates'] |= measure['aggregates']
+
+    frequent = [shape for shape in shapes.values() if shape['count'] >= min_queries]
+    return sorted(frequent, key=lambda shape: shape['count'], reverse=True)
+
+
+def _rollup_name(dims):
+    digest = hashlib.sha1('\n'.join(sorted(dims)).encode('utf-8')).hexdigest()[:12]
+    return f'rollup_{digest}'
+
+
+def _plan_rollup(shape):
+    """根据查询形状生成预聚合表的列定义和构建SQL"""
+    dims = []
+    for i, sql in enumerate(sorted(shape['dims'].values())):
+        expression = sql_ast.parse_expression(sql)
+        column = expression['column_names'][-1] if expression['class'] == 'COLUMN_REF' else f'__dim{i}'
+        dims.append({'sql': sql, 'column': column})
+
+    measures = []
+    for i, measure in enumerate(sorted(shape['measures'].values(), key=lambda m: m['sql'])):
+        expression = sql_ast.parse_expression(measure['sql'])
+        suffix = expression['column_names'][-1] if expression['class'] == 'COLUMN_REF' else f'm{i}'
+        aggregates = set(measure['aggregates'])
+        if 'avg' in aggregates:
+            aggregates |= {'sum', 'count'}
+        aggregates.discard('avg')
+        measures.append({
+            'sql': measure['sql'],
+            'columns': {agg: f'{agg}__{suffix}' for agg in sorted(aggregates)}
+        })
+
+    select_items = [f'{dim["sql"]} AS "{dim["column"]}"' for dim in dims]
+    select_items.append(f'COUNT(*) AS "{ROWS_COLUMN}"')
+    for measure in measures:
+        for agg, column in measure['columns'].items():
+            select_items.append(f'{agg.upper()}({measure["sql"]}) AS "{column}"')
+
+    build_sql = f'SELECT {", ".join(select_items)} FROM data_table'
+    if dims:
+        build_sql += f' GROUP BY {", ".join(str(i + 1) for i in range(len(dims)))}'
+
+    return {'name': _rollup_name(shape['dims']), 'dims': dims, 'measures': measures, 'build_sql': build_sql}
+
+
+def _meta_table_exists(conn):
+    return conn.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?", [META_TABLE]
+    ).fetchone()[0] > 0
+
+
+def _read_metadata(conn):
+    if not _meta_table_exists(conn):
+        return []
+    rows = conn.execute(
+        f'SELECT name, dims, measures, data_version, row_count, skipped FROM {META_TABLE}'
+    ).fetchall()
+    return [{
+        'name': row[0],
+        'dims': json.loads(row[1]),
+        'measures': json.loads(row[2]),
+        'data_version': row[3],
+        'row_count': row[4],
+        'skipped': row[5]
+    } for row in rows]
+
+
+def load_rollups(db_path, data_version):
+    """读取与当前数据版本一致的可用预聚合表，按数据库文件的修改时间缓存"""
+    try:
+        stat = os.stat(db_path)
+    except OSError:
+        return []
+    cache_key = (db_path, stat.st_mtime_ns, stat.st_size)
+
+    with _metadata_cache_lock:
+        cached = _metadata_cache.get(db_path)
+    if cached and cached[0] == cache_key:
+        rollups = cached[1]
+    else:
+        with storage.connect_read(db_path) as conn:
+            rollups = _read_metadata(conn)
+        with _metadata_cache_lock:
+            _metadata_cache[db_path] = (cache_key, rollups)
+
+    return [r for r in rollups if not r['skipped'] and r['data_version'] == data_version]
+
+
+def drop_rollups(conn):
+    """删除数据集中的所有预聚合表，需在写连接中调用（例如追加数据时）"""
+    if not _meta_table_exists(conn):
+        return
+    for rollup in _read_metadata(conn):
+        conn.execute(f'DROP TABLE IF EXISTS "{rollup["name"]}"')
+    conn.execute(f'DELETE FROM {META_TABLE}')
+
+
+def refresh_rollups(db_path, data_info, queries, min_queries=3, max_rollups=5, min_rows=100000):
+    """根据历史查询构建缺失或过期的预聚合表
+
+    聚合计算在只读连接中完成，只有写入较小的结果时才短暂持有写锁，不会长时间阻塞查询。
+
+    Args:
+        db_path (str): 数据集的DuckDB数据库文件路径
+        data_info (dict): 数据概要信息
+        queries (list): 该数据集历史生成的SQL
+        min_queries (int): 查询形状至少出现的次数
+        max_rollups (int): 最多物化的预聚合表数量
+        min_rows (int): 数据集行数低于该值时不构建
+
+    Returns:
+        list: 新构建的预聚合表名称
+    """
+    if data_info.get('行数', 0) < min_rows:
+        return []
+
+    data_version = data_info.get('data_version', 0)
+    shapes = mine_frequent_shapes(queries, min_queries)[:max_rollups]
+    if not shapes:
+        return []
+
+    with storage.connect_read(db_path) as conn:
+        existing = {r['name']: r for r in _read_metadata(conn)}
+
+    built = []
+    for shape in shapes:
+        plan = _plan_rollup(shape)
+        current = existing.get(plan['name'])
+        if current and current['data_version'] == data_version and _covers(current, plan):
+            continue
+
+        with metrics.span('rollup.build'):
+            with storage.connect_read(db_path) as conn:
+                rollup_data = conn.execute(plan['build_sql']).fetch_arrow_table()
+
+            skipped = rollup_data.num_rows > data_info['行数'] * MAX_ROLLUP_RATIO
+            with storage.connect_write(db_path) as conn:
+                conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {META_TABLE} (
+                        name VARCHAR, dims VARCHAR, measures VARCHAR, data_version INTEGER,
+                        row_count BIGINT, skipped BOOLEAN, created_at TIMESTAMP
+                    )
+                ''')
+                conn.execute(f'DELETE FROM {META_TABLE} WHERE name = ?', [plan['name']])
+                conn.execute(f'DROP TABLE IF EXISTS "{plan["name"]}"')
+                if not skipped:
+                    conn.execute(f'CREATE TABLE "{plan["name"]}" AS SELECT * FROM rollup_data')
+                conn.execute(f'INSERT INTO {META_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                    plan['name'],
+                    json.dumps(plan['dims'], ensure_ascii=False),
+                    json.dumps(plan['measures'], ensure_ascii=False),
+                    data_version,
+                    rollup_data.num_rows,
+                    skipped,
+                    datetime.now()
+                ])
+
+        if not skipped:
+            metrics.inc('rollups_built_total')
+            built.append(plan['name'])
+
+    return built
+
+
+def _covers(rollup, plan):
+    """已有预聚合表是否包含计划中的所有度量列"""
+    if rollup['skipped']:
+        return True
+    existing = {m['sql']: set(m['columns']) for m in rollup['measures']}
+    return all(set(m['columns']) <= existing.get(m['sql'], set()) for m in plan['measures'])
+
+
+def refresh_rollups_in_background(db_path, data_info, queries, **options):
+    """在后台线程中刷新预聚合表，同一数据集同时只有一个刷新任务"""
+    with _building_lock:
+        if db_path in _building:
+            return
+        _building.add(db_path)
+
+    def run():
+        try:
+            refresh_rollups(db_path, data_info, queries, **options)
+        except Exception as e:
+            print(f"预聚合表构建失败: {str(e)}")
+        finally:
+            with _building_lock:
+                _building.discard(db_path)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def rewrite_with_rollups(sql, rollups):
+    """尝试将查询改写为读取预聚合表
+
+    Args:
+        sql (str): 生成的SQL
+        rollups (list): load_rollups 返回的可用预聚合表
+
+    Returns:
+        tuple: (改写后的SQL, 预聚合表元数据)，无法改写时返回 (None, None)
+    """
+    if not rollups:
+        return None, None
+    shape = extract_shape(sql)
+    if shape is None:
+        return None, None
+
+    # 优先使用行数最少的预聚合表
+    for rollup in sorted(rollups, key=lambda r: r['row_count']):
+        try:
+            return _rewrite(sql, rollup), rollup
+        except CannotRewrite:
+            continue
+    return None, None
+
+
+def _rewrite(sql, rollup):
+    tree, node = sql_ast.parse_select(sql)
+    dim_columns = {sql_ast.canonical(sql_ast.parse_expression(dim['sql'])): dim['column']
+                   for dim in rollup['dims']}
+    measure_columns = {sql_ast.canonical(sql_ast.parse_expression(m['sql'])): m['columns']
+                       for m in rollup['measures']}
+    aliases = {item['alias'].lower() for item in node['select_list'] if item.get('alias')}
+    aggregate_names = sql_ast.aggregate_function_names()
+
+    def replace_aggregate(expression):
+        name = expression['function_name'].lower()
+        if name == 'count_star':
+            text = f'CAST(SUM("{ROWS_COLUMN}") AS BIGINT)'
+        else:
+            columns = measure_columns.get(sql_ast.canonical(expression['children'][0]))
+            if columns is None:
+                raise CannotRewrite()
+            if name == 'avg':
+                if 'sum' not in columns or 'count' not in columns:
+                    raise CannotRewrite()
+                text = f'SUM("{columns["sum"]}") / SUM("{columns["count"]}")'
+            elif name not in columns:
+                raise CannotRewrite()
+            elif name == 'count':
+                text = f'CAST(SUM("{columns["count"]}") AS BIGINT)'
+            elif name == 'sum':
+                text = f'SUM("{columns["sum"]}")'
+            else:
+                text = f'{name.upper()}("{columns[name]}")'
+        replacement = sql_ast.parse_expression(text)
+        replacement['alias'] = expression.get('alias', '')
+        return replacement
+
+    def rewrite(expression, allow_aliases):
+        if isinstance(expression, list):
+            return [rewrite(item, allow_aliases) for item in expression]
+        if not isinstance(expression, dict):
+            return expression
+        if 'class' not in expression:
+            return {k: rewrite(v, allow_aliases) for k, v in expression.items()}
+
+        key = sql_ast.canonical(expression)
+        if key in dim_columns:
+            return sql_ast.column_ref(dim_columns[key], alias=expression.get('alias', ''))
+        if expression['class'] in ('WINDOW', 'SUBQUERY', 'STAR'):
+            raise CannotRewrite()
+        if expression['class'] == 'FUNCTION' and expression['function_name'].lower() in aggregate_names:
+            return replace_aggregate(expression)
+        if expression['class'] == 'COLUMN_REF':
+            # ORDER BY / HAVING 中可以引用SELECT列的别名
+            if allow_aliases and expression['column_names'][-1].lower() in aliases:
+                return expression
+            raise CannotRewrite()
+        return {k: rewrite(v, allow_aliases) for k, v in expression.items()}
+
+    group_expressions = _resolve_group_aliases(node)
+    select_list = []
+    for item in node['select_list']:
+        rewritten = rewrite(item, False)
+        # 保持结果列名不变
+        if not item.get('alias'):
+            rewritten['alias'] = sql_ast.output_name(item)
+        select_list.append(rewritten)
+    node['select_list'] = select_list
+    node['where_clause'] = rewrite(node.get('where_clause'), False)
+    node['group_expressions'] = rewrite(group_expressions, False)
+    node['having'] = rewrite(node.get('having'), True)
+    node['modifiers'] = rewrite(node.get('modifiers') or [], True)
+    node['from_table']['table_name'] = rollup['name']
+    node['from_table']['schema_name'] = ''
+    node['from_table']['catalog_name'] = ''
+
+    return sql_ast.deparse(tree)
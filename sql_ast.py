@@ -0,0 +1,204 @@
+"""基于 DuckDB 自带解析器的SQL语法树工具
+
+使用 json_serialize_sql / json_deserialize_sql 在SQL文本和JSON语法树之间转换，
+不引入额外的SQL解析依赖。供预聚合改写、近似查询等需要分析或改写生成SQL的功能使用。
+"""
+import copy
+import json
+import threading
+
+import duckdb
+
+_local = threading.local()
+
+# 比较两个表达式是否相同时忽略的字段
+_IGNORED_KEYS = {'query_location', 'alias'}
+
+
+def _connection():
+    """每个线程使用独立的内存连接，只用于解析，不访问任何数据"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = duckdb.connect()
+    return conn
+
+
+def aggregate_function_names():
+    """DuckDB 中所有聚合函数的名称"""
+    names = getattr(_local, 'aggregate_names', None)
+    if names is None:
+        rows = _connection().execute(
+            "SELECT DISTINCT function_name FROM duckdb_functions() WHERE function_type = 'aggregate'"
+        ).fetchall()
+        names = _local.aggregate_names = {row[0].lower() for row in rows}
+    return names
+
+
+def find_aggregates(value):
+    """查找表达式中的所有聚合函数调用节点"""
+    found = []
+    aggregate_names = aggregate_function_names()
+
+    def walk(item):
+        if isinstance(item, dict):
+            if item.get('class') == 'FUNCTION' and item.get('function_name', '').lower() in aggregate_names:
+                found.append(item)
+                return
+            for v in item.values():
+                walk(v)
+        elif isinstance(item, list):
+            for v in item:
+                walk(v)
+
+    walk(value)
+    return found
+
+
+def parse(sql):
+    """将SQL解析为JSON语法树，解析失败或包含多条语句时返回None"""
+    try:
+        text = _connection().execute('SELECT json_serialize_sql(?)', [sql]).fetchone()[0]
+    except duckdb.Error:
+        return None
+    tree = json.loads(text)
+    if tree.get('error') or len(tree.get('statements', [])) != 1:
+        return None
+    return tree
+
+
+def parse_select(sql):
+    """解析单条SELECT语句，返回 (语法树, SELECT节点)，无法解析时返回 (None, None)"""
+    tree = parse(sql)
+    if tree is None:
+        return None, None
+    node = tree['statements'][0]['node']
+    if node.get('type') != 'SELECT_NODE':
+        return None, None
+    return tree, node
+
+
+def deparse(tree):
+    """将JSON语法树还原为SQL文本"""
+    return _connection().execute('SELECT json_deserialize_sql(?)', [json.dumps(tree)]).fetchone()[0]
+
+
+def parse_expression(sql):
+    """解析单个表达式"""
+    _, node = parse_select(f'SELECT {sql}')
+    if node is None or len(node['select_list']) != 1:
+        return None
+    expression = node['select_list'][0]
+    expression['alias'] = ''
+    return expression
+
+
+def expression_sql(expression):
+    """将表达式节点还原为SQL文本，与DuckDB为未命名列生成的列名一致"""
+    tree, _ = parse_select('SELECT 1')
+    expression = dict(expression, alias='')
+    tree['statements'][0]['node']['select_list'] = [expression]
+    return deparse(tree)[len('SELECT '):]
+
+
+def output_name(expression):
+    """SELECT列表中表达式对应的结果列名"""
+    if expression.get('alias'):
+        return expression['alias']
+    if expression.get('class') == 'COLUMN_REF':
+        return expression['column_names'][-1]
+    return expression_sql(expression)
+
+
+def canonical(expression):
+    """表达式的规范化表示，用于判断两个表达式是否等价"""
+    def strip(value):
+        if isinstance(value, dict):
+            return {k: strip(v) for k, v in value.items() if k not in _IGNORED_KEYS}
+        if isinstance(value, list):
+            return [strip(v) for v in value]
+        return value
+
+    def normalize_names(value):
+        # 列名不区分大小写
+        if isinstance(value, dict):
+            if value.get('class') == 'COLUMN_REF':
+                return dict(value, column_names=[name.lower() for name in value['column_names']])
+            return {k: normalize_names(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [normalize_names(v) for v in value]
+        return value
+
+    return json.dumps(normalize_names(strip(expression)), sort_keys=True, ensure_ascii=False)
+
+
+def column_ref(name, alias=''):
+    """构造列引用节点"""
+    expression = parse_expression(f'"{name}"')
+    expression['alias'] = alias
+    return expression
+
+
+def column_names(expression):
+    """表达式中引用的所有列名（小写）"""
+    names = set()
+
+    def walk(value):
+        if isinstance(value, dict):
+            if value.get('class') == 'COLUMN_REF':
+                names.add(value['column_names'][-1].lower())
+            for v in value.values():
+                walk(v)
+        elif isinstance(value, list):
+            for v in value:
+                walk(v)
+
+    walk(expression)
+    return names
+
+
+def contains_class(value, classes):
+    """语法树中是否包含指定类别（如 WINDOW、SUBQUERY）的节点"""
+    if isinstance(value, dict):
+        if value.get('class') in classes:
+            return True
+        return any(contains_class(v, classes) for v in value.values())
+    if isinstance(value, list):
+        return any(contains_class(v, classes) for v in value)
+    return False
+
+
+def constant_value(expression):
+    """常量节点的值，非常量返回None"""
+    if expression and expression.get('class') == 'CONSTANT':
+        return expression['value'].get('value')
+    return None
+
+
+def split_conjunction(expression):
+    """将 AND 连接的条件拆分为列表"""
+    if expression is None:
+        return []
+    if expression.get('type') == 'CONJUNCTION_AND':
+        parts = []
+        for child in expression['children']:
+            parts.extend(split_conjunction(child))
+        return parts
+    return [expression]
+
+
+def is_simple_select(node, table_name='data_table'):
+    """是否为直接查询单张数据表的简单SELECT（无CTE、子查询、连接、采样）"""
+    from_table = node.get('from_table') or {}
+    return (
+        from_table.get('type') == 'BASE_TABLE'
+        and from_table.get('table_name', '').lower() == table_name
+        and not from_table.get('sample')
+        and not node.get('sample')
+        and not node.get('cte_map', {}).get('map')
+        and not node.get('qualify')
+        and len(node.get('group_sets') or []) <= 1
+    )
+
+
+def clone(value):
+    return copy.deepcopy(value)
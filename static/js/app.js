@@ -1,8 +1,14 @@
 $(document).ready(function() {
     let selectedFile = null;
-    let chatHistory = [];
     let allSessions = [];
     let currentSessionId = null;
+    // 各会话的本地聊天记录和已同步到的版本号，切换会话时只拉取增量
+    const sessionStates = {};
+    // marked.parse 的渲染结果，键为聊天记录ID，记录版本号变化时重新渲染
+    const renderedMarkdown = new Map();
+    // 进行中的请求，重复触发时取消前一个，只保留最后一次
+    let pendingSwitch = null;
+    let pendingFiles = null;
 
     // 初始化
     init();
@@ -70,9 +76,9 @@ $(document).ready(function() {
             }
         });
 
-        // 会话切换时重新加载文件列表
+        // 点击会话切换
         $('#chatHistory').on('click', '.session-item', function() {
-            setTimeout(loadFilesList, 500);
+            switchToSession($(this).data('session-id'));
         });
     }
 
@@ -82,12 +88,12 @@ $(document).ready(function() {
 
         // 检查文件类型
         const allowedTypes = ['text/csv', 'application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/json'];
-        const allowedExtensions = ['.csv', '.xls', '.xlsx', '.parquet', '.json'];
+        const allowedExtensions = ['.csv', '.xls', '.xlsx', '.parquet', '.json', '.zip', '.tar', '.gz', '.tgz'];
 
         const fileExtension = '.' + file.name.split('.').pop().toLowerCase();
 
         if (!allowedTypes.includes(file.type) && !allowedExtensions.includes(fileExtension)) {
-            showError('不支持的文件类型。请选择 CSV, Excel, Parquet 或 JSON 文件。');
+            showError('不支持的文件类型。请选择 CSV, Excel, Parquet, JSON 文件或其 zip / tar 压缩包。');
             return;
         }
 
@@ -136,7 +142,7 @@ $(document).ready(function() {
                     loadFilesList(); // 重新加载文件列表
                     // 显示文件信息
                     $('#fileInfo').removeClass('hidden');
-                    addMessage('user', '已上传文件：' + selectedFile.name, selectedFile.name);
+                    addMessage('已上传文件：' + selectedFile.name, selectedFile.name);
                     removeFile(); // 重置上传区域
                 } else {
                     showError(response.error || '文件上传失败');
@@ -165,7 +171,16 @@ $(document).ready(function() {
 
     // 加载已上传文件列表
     function loadFilesList() {
-        $.get('/api/files')
+        if (pendingFiles) {
+            pendingFiles.abort();
+        }
+        const request = pendingFiles = $.get('/api/files');
+        request
+            .always(function() {
+                if (pendingFiles === request) {
+                    pendingFiles = null;
+                }
+            })
             .done(function(response) {
                 const files = response.files || [];
                 const selectElement = $('#selectedFile');
@@ -178,8 +193,10 @@ $(document).ready(function() {
                     selectElement.append(`<option value="${file.id}">${file.filename}</option>`);
                 });
             })
-            .fail(function() {
-                console.error('加载文件列表失败');
+            .fail(function(xhr, status) {
+                if (status !== 'abort') {
+                    console.error('加载文件列表失败');
+                }
             });
     }
 
@@ -213,8 +230,11 @@ $(document).ready(function() {
         // 获取选中的文件名
         const filename = $('#selectedFile option:selected').text();
         
-        // 添加用户消息到聊天区域
-        addMessage('user', question, filename);
+        // 添加用户消息到聊天区域，收到回答后替换为完整的对话
+        $('#welcomeMessage').remove();
+        const pendingEntry = $(`<div class="chat-entry">${renderUserMessage(question, filename, new Date())}</div>`);
+        $('#chatMessages').append(pendingEntry);
+        scrollToBottom();
 
         // 发送请求
         $.ajax({
@@ -230,8 +250,21 @@ $(document).ready(function() {
             success: function(response) {
                 showLoading(false);
                 if (response.success) {
-                    addMessage('ai', response.markdown_result, null, response.chat_id);
-                    loadAllSessions(); // 重新加载会话列表
+                    const chat = {
+                        id: response.chat_id,
+                        version: response.version,
+                        timestamp: response.timestamp,
+                        question: question,
+                        filename: filename,
+                        markdown_result: response.markdown_result,
+                        approximate: response.approximate
+                    };
+                    // 直接更新本地状态，不重新拉取聊天历史和会话列表
+                    currentSessionId = response.session_id;
+                    mergeHistory(getSessionState(response.session_id), [chat]);
+                    pendingEntry.replaceWith(renderChatEntry(chat));
+                    scrollToBottom();
+                    touchSession(response.session_id, chat);
                     $('#questionInput').val(''); // 只清空问题输入框，保留文件选择
                 } else {
                     showError(response.error || '分析失败');
@@ -267,49 +300,65 @@ $(document).ready(function() {
         });
     }
 
-    // 添加消息到聊天区域
-    function addMessage(type, content, filename = null, chatId = null) {
-        const timestamp = new Date().toLocaleString('zh-CN');
-        let messageHtml = '';
-
-        if (type === 'user') {
-            messageHtml = `
-                <div class="flex justify-end mb-4">
-                    <div class="max-w-3xl">
-                        <div class="bg-blue-600 rounded-lg p-4">
-                            <div class="flex items-center mb-2">
-                                <i class="fas fa-file-alt mr-2 text-blue-200"></i>
-                                <span class="text-sm text-blue-200">${filename}</span>
-                            </div>
-                            <div class="text-white">${escapeHtml(content)}</div>
-                            <div class="text-xs text-blue-200 mt-2">${timestamp}</div>
-                        </div>
-                    </div>
-                </div>
-            `;
-        } else if (type === 'ai') {
-            // content现在是markdown格式的字符串
-            const markdownContent = content;
-
-            messageHtml = `
-                <div class="flex mb-4">
-                    <div class="w-8 h-8 bg-green-600 rounded-full flex items-center justify-center mr-3 flex-shrink-0 mt-1">
-                        <i class="fas fa-robot text-sm"></i>
-                    </div>
-                    <div class="flex-1 max-w-4xl">
-                        <div class="bg-gray-800 border border-gray-700 rounded-lg p-4">
-                            <div class="markdown-content">${marked.parse(markdownContent)}</div>
-                            <div class="text-xs text-gray-400 mt-3">${timestamp}</div>
+    // 添加消息到聊天区域（上传提示等不属于聊天记录的消息）
+    function addMessage(content, filename) {
+        $('#welcomeMessage').remove();
+        $('#chatMessages').append(renderUserMessage(content, filename, new Date()));
+        scrollToBottom();
+    }
+
+    // 用户消息的HTML
+    function renderUserMessage(content, filename, time) {
+        const timestamp = new Date(time).toLocaleString('zh-CN');
+        return `
+            <div class="flex justify-end mb-4">
+                <div class="max-w-3xl">
+                    <div class="bg-blue-600 rounded-lg p-4">
+                        <div class="flex items-center mb-2">
+                            <i class="fas fa-file-alt mr-2 text-blue-200"></i>
+                            <span class="text-sm text-blue-200">${filename}</span>
                         </div>
+                        <div class="text-white">${escapeHtml(content)}</div>
+                        <div class="text-xs text-blue-200 mt-2">${timestamp}</div>
                     </div>
                 </div>
-            `;
+            </div>
+        `;
+    }
+
+    // AI回答的HTML，markdown渲染结果按记录版本缓存
+    function renderAiMessage(chat) {
+        const timestamp = new Date(chat.timestamp).toLocaleString('zh-CN');
+        let rendered = renderedMarkdown.get(chat.id);
+        if (!rendered || rendered.version !== chat.version) {
+            rendered = {version: chat.version, html: marked.parse(chat.markdown_result || '')};
+            renderedMarkdown.set(chat.id, rendered);
         }
 
-        $('#chatMessages').append(messageHtml);
-        scrollToBottom();
+        return `
+            <div class="flex mb-4">
+                <div class="w-8 h-8 bg-green-600 rounded-full flex items-center justify-center mr-3 flex-shrink-0 mt-1">
+                    <i class="fas fa-robot text-sm"></i>
+                </div>
+                <div class="flex-1 max-w-4xl">
+                    <div class="bg-gray-800 border border-gray-700 rounded-lg p-4">
+                        <div class="markdown-content">${rendered.html}</div>
+                        <div class="text-xs text-gray-400 mt-3">${timestamp}</div>
+                    </div>
+                </div>
+            </div>
+        `;
     }
 
+    // 一次问答（用户问题和AI回答）的HTML
+    function renderChatEntry(chat) {
+        return `
+            <div class="chat-entry" data-chat-id="${chat.id}">
+                ${renderUserMessage(chat.question, chat.filename, chat.timestamp)}
+                ${renderAiMessage(chat)}
+            </div>
+        `;
+    }
 
     // 加载所有会话
     function loadAllSessions() {
@@ -325,10 +374,15 @@ $(document).ready(function() {
 
     // 加载聊天历史
     function loadChatHistory() {
-        $.get('/api/chat_history')
+        $.get('/api/chat_history', {light: 1})
             .done(function(response) {
-                chatHistory = response.history || [];
+                if (!response.session_id) {
+                    return;
+                }
+                currentSessionId = response.session_id;
+                mergeHistory(getSessionState(currentSessionId), response.history, response.version);
                 renderCurrentChatHistory();
+                highlightCurrentSession();
             })
             .fail(function() {
                 console.error('加载聊天历史失败');
@@ -373,20 +427,78 @@ $(document).ready(function() {
         });
 
         historyContainer.html(historyHtml);
+        highlightCurrentSession();
+    }
 
-        // 点击会话切换
-        $('.session-item').on('click', function() {
-            const sessionId = $(this).data('session-id');
-            switchToSession(sessionId);
+    // 高亮当前选中的会话
+    function highlightCurrentSession() {
+        $('.session-item').removeClass('bg-blue-700');
+        if (currentSessionId) {
+            $(`.session-item[data-session-id="${currentSessionId}"]`).addClass('bg-blue-700');
+        }
+    }
+
+    // 有新的问答后在本地更新会话列表中的对应会话并移到最前
+    function touchSession(sessionId, chat) {
+        let sessionInfo = allSessions.find(s => s.id === sessionId);
+        if (sessionInfo) {
+            allSessions = allSessions.filter(s => s.id !== sessionId);
+        } else {
+            sessionInfo = {id: sessionId, created_at: chat.timestamp, chat_count: 0};
+        }
+        sessionInfo.chat_count += 1;
+        sessionInfo.updated_at = chat.timestamp;
+        sessionInfo.latest_question = chat.question;
+        sessionInfo.latest_filename = chat.filename;
+        allSessions.unshift(sessionInfo);
+        renderSessionList();
+    }
+
+    // 获取会话的本地状态
+    function getSessionState(sessionId) {
+        if (!sessionStates[sessionId]) {
+            sessionStates[sessionId] = {records: [], version: 0};
+        }
+        return sessionStates[sessionId];
+    }
+
+    // 把服务端返回的增量记录合并到本地状态，返回新增和更新的记录
+    function mergeHistory(state, history, version = 0) {
+        const added = [];
+        const updated = [];
+        (history || []).forEach(chat => {
+            const index = state.records.findIndex(r => r.id === chat.id);
+            if (index === -1) {
+                state.records.push(chat);
+                added.push(chat);
+            } else if (state.records[index].version !== chat.version) {
+                state.records[index] = chat;
+                updated.push(chat);
+            }
         });
+        state.version = Math.max(state.version, version);
+        return {added, updated};
+    }
+
+    // 只把增量变化应用到页面上，不重新渲染已有的消息
+    function patchChatHistory(changes) {
+        changes.updated.forEach(chat => {
+            $(`.chat-entry[data-chat-id="${chat.id}"]`).replaceWith(renderChatEntry(chat));
+        });
+        if (changes.added.length > 0) {
+            $('#welcomeMessage').remove();
+            $('#chatMessages').append(changes.added.map(renderChatEntry).join(''));
+            scrollToBottom();
+        }
     }
 
     // 渲染当前会话的聊天历史
     function renderCurrentChatHistory() {
-        if (chatHistory.length === 0) {
+        const records = currentSessionId ? getSessionState(currentSessionId).records : [];
+        if (records.length === 0) {
             // 显示欢迎消息
             $('#chatMessages').html(`
-                <div class="bg-gray-800 rounded-lg p-4 border border-gray-700">
+                <div id="welcomeMessage" class="bg-gray-800 rounded-lg p-4 border border-gray-700">
                     <div class="flex items-center mb-2">
                         <div class="w-8 h-8 bg-blue-600 rounded-full flex items-center justify-center mr-3">
                             <i class="fas fa-robot text-sm"></i>
@@ -401,31 +513,44 @@ $(document).ready(function() {
             return;
         }
 
-        // 清空聊天区域并重新渲染所有消息
-        $('#chatMessages').empty();
-        chatHistory.forEach(chat => {
-            addMessage('user', chat.question, chat.filename);
-            const content = chat.markdown_result || chat.result;
-            addMessage('ai', content, null, chat.id);
-        });
+        // 一次性替换聊天区域，已渲染过的markdown直接使用缓存
+        $('#chatMessages').html(records.map(renderChatEntry).join(''));
+        scrollToBottom();
     }
 
-    // 切换到指定会话
+    // 切换到指定会话：先用本地缓存渲染，再只拉取该会话的增量记录
     function switchToSession(sessionId) {
-        $.post(`/api/switch_session/${sessionId}`)
+        const state = getSessionState(sessionId);
+        if (sessionId !== currentSessionId) {
+            currentSessionId = sessionId;
+            renderCurrentChatHistory();
+            highlightCurrentSession();
+        }
+
+        // 快速连续切换时取消前一次请求，服务端会话以最后一次为准
+        if (pendingSwitch) {
+            pendingSwitch.abort();
+        }
+        const request = pendingSwitch = $.post(`/api/switch_session/${sessionId}?since=${state.version}&light=1`);
+        request
+            .always(function() {
+                if (pendingSwitch === request) {
+                    pendingSwitch = null;
+                }
+            })
             .done(function(response) {
                 if (response.success) {
-                    currentSessionId = sessionId;
-                    loadChatHistory();
+                    const changes = mergeHistory(state, response.history, response.version);
+                    if (sessionId === currentSessionId) {
+                        patchChatHistory(changes);
+                    }
                     loadFilesList(); // 加载当前会话的文件列表
-
-                    // 高亮当前选中的会话
-                    $('.session-item').removeClass('bg-blue-700');
-                    $(`.session-item[data-session-id="${sessionId}"]`).addClass('bg-blue-700');
                 }
             })
-            .fail(function() {
-                showError('切换会话失败');
+            .fail(function(xhr, status) {
+                if (status !== 'abort') {
+                    showError('切换会话失败');
+                }
             });
     }
 
@@ -434,21 +559,22 @@ $(document).ready(function() {
         $.post('/api/new_session')
             .done(function(response) {
                 if (response.session_id) {
+                    if (pendingSwitch) {
+                        pendingSwitch.abort();
+                    }
                     currentSessionId = response.session_id;
 
                     // 清空当前聊天区域
-                    chatHistory = [];
                     renderCurrentChatHistory();
 
                     // 重置表单
                     resetForm();
 
-                    // 重新加载会话列表和文件列表以显示新会话
-                    loadAllSessions();
+                    // 在本地会话列表中加入新会话，并重新加载文件列表
+                    const now = new Date().toISOString();
+                    allSessions.unshift({id: currentSessionId, created_at: now, updated_at: now, chat_count: 0});
+                    renderSessionList();
                     loadFilesList();
-
-                    // 清除会话高亮
-                    $('.session-item').removeClass('bg-blue-700');
                 }
             })
             .fail(function() {
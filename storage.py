@@ -0,0 +1,134 @@
+"""数据集DuckDB文件的访问控制
+
+多进程部署时，同一个 .duckdb 文件可能被多个工作进程同时访问。DuckDB 以读写方式
+打开文件时会独占文件锁，其他进程（即使是只读）都无法再打开，因此约定：
+
+- 写入（导入、追加等）通过 connect_write 获取，持有该文件的独占锁，同一时刻只有一个写入者
+- 查询通过 connect_read 获取，以 read_only=True 打开并持有共享锁，多个读者可以并行
+
+锁文件与数据库文件放在一起（<db_path>.lock），基于 fcntl.flock，对同一进程内的
+多个线程同样有效。锁文件只在持有独占锁时随数据库一起删除，获取锁后会检查锁文件
+是否仍是打开的那一个。不支持 fcntl 的平台（Windows）退化为进程内互斥锁，适用于单进程运行。
+"""
+import os
+import threading
+from contextlib import ExitStack, contextmanager
+
+import duckdb
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+
+def lock_path(db_path):
+    """数据库文件对应的锁文件路径"""
+    return db_path + '.lock'
+
+
+@contextmanager
+def _file_lock(db_path, exclusive):
+    if fcntl is None:
+        with _local_locks_guard:
+            lock = _local_locks.setdefault(os.path.abspath(db_path), threading.Lock())
+        with lock:
+            yield
+        return
+
+    path = lock_path(db_path)
+    while True:
+        f = open(path, 'a+')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        # 等待期间锁文件可能已随数据库一起被删除，此时持有的是旧文件上的锁，
+        # 与之后打开新锁文件的进程互不排斥，需要重新打开
+        try:
+            current = os.stat(path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current == os.fstat(f.fileno()).st_ino:
+            break
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+
+@contextmanager
+def _timed(stage):
+    if stage is None:
+        yield
+    else:
+        with metrics.span(stage):
+            yield
+
+
+@contextmanager
+def connect_read(db_path, stage=None):
+    """以只读方式打开数据集数据库，等待正在进行的写入完成
+
+    stage 不为空时，等待锁和建立连接的耗时计入该阶段
+    """
+    with ExitStack() as stack:
+        with _timed(stage):
+            stack.enter_context(_file_lock(db_path, exclusive=False))
+            conn = duckdb.connect(db_path, read_only=True)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+@contextmanager
+def connect_write(db_path, stage=None):
+    """以读写方式打开数据集数据库，持有独占锁直到连接关闭
+
+    stage 不为空时，等待锁和建立连接的耗时计入该阶段
+    """
+    with ExitStack() as stack:
+        with _timed(stage):
+            stack.enter_context(_file_lock(db_path, exclusive=True))
+            conn = duckdb.connect(db_path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+@contextmanager
+def lock_exclusive(db_path):
+    """只获取独占锁而不打开连接，用于替换或删除数据库文件等文件级操作"""
+    with _file_lock(db_path, exclusive=True):
+        yield
+
+
+def database_files(db_path):
+    """数据库文件及其WAL文件的路径"""
+    return [db_path, db_path + '.wal']
+
+
+def remove_database(db_path):
+    """删除数据集数据库文件，等待正在进行的读写完成
+
+    Returns:
+        int: 释放的字节数
+    """
+    freed = 0
+    with lock_exclusive(db_path):
+        for path in database_files(db_path):
+            if os.path.exists(path):
+                freed += os.path.getsize(path)
+                os.remove(path)
+        # 持有独占锁时删除锁文件，正在等待的进程获得锁后会发现锁文件已变化并重新打开
+        if fcntl is not None and os.path.exists(lock_path(db_path)):
+            os.remove(lock_path(db_path))
+    return freed
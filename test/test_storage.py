@@ -0,0 +1,58 @@
+import os
+import threading
+
+import duckdb
+import pytest
+
+import storage
+
+fcntl = pytest.importorskip('fcntl')
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'data.duckdb')
+    with storage.connect_write(path) as conn:
+        conn.execute('CREATE TABLE data_table AS SELECT range AS id FROM range(100)')
+    return path
+
+
+def test_remove_database_removes_lock_file(db_path):
+    freed = storage.remove_database(db_path)
+
+    assert freed > 0
+    assert not os.path.exists(db_path)
+    assert not os.path.exists(storage.lock_path(db_path))
+
+
+def test_waiting_reader_reopens_replaced_lock_file(db_path):
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def reader():
+        with storage._file_lock(db_path, exclusive=False):
+            acquired.set()
+            release.wait(5)
+
+    with storage.lock_exclusive(db_path):
+        thread = threading.Thread(target=reader)
+        thread.start()
+        # 读者已打开旧的锁文件并在等待，此时与 remove_database 一样在持有锁时删除数据库和锁文件，
+        # 随后重新创建数据库
+        threading.Event().wait(0.2)
+        for path in storage.database_files(db_path) + [storage.lock_path(db_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+        with storage.connect_write(db_path) as conn:
+            conn.execute('CREATE TABLE data_table AS SELECT 1 AS id')
+    assert acquired.wait(5)
+
+    # 读者持有的是新锁文件上的共享锁，新的写入者无法获得独占锁
+    with open(storage.lock_path(db_path), 'a+') as f:
+        with pytest.raises(BlockingIOError):
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    release.set()
+    thread.join()
+
+    with storage.connect_read(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM data_table').fetchone()[0] == 1